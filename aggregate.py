@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# Running min/max/mean/last per field over fixed time windows, so that
+# only one point per window has to be written to the database. Windows
+# are aligned to multiples of their length since the epoch, a window is
+# emitted when the first sample of the next one arrives.
+#
+
+import logging
+
+log = logging.getLogger('aggregate')
+
+
+class WindowAggregator:
+    def __init__(self, window):
+        self.window = window
+        self.t_window = None  # start of the current window
+        self.acc = dict()  # name -> [min, max, sum, n, last]
+
+    def add(self, t, fields):
+        '''Add fields sampled at t (seconds since epoch).
+
+        Returns (t_window, aggregated fields) of the previous window when
+        t starts a new one, otherwise None.
+        '''
+        ret = None
+        t_window = t - t % self.window
+        if self.t_window is not None and t_window != self.t_window:
+            ret = self.flush()
+        self.t_window = t_window
+
+        for name, v in fields.items():
+            a = self.acc.get(name)
+            if not isinstance(v, (int, float)):
+                # strings etc. can only be passed through
+                self.acc[name] = [None, None, None, 0, v]
+            elif a is None or not a[3]:
+                self.acc[name] = [v, v, v, 1, v]
+            else:
+                a[0] = min(a[0], v)
+                a[1] = max(a[1], v)
+                a[2] += v
+                a[3] += 1
+                a[4] = v
+        return ret
+
+    def flush(self):
+        if self.t_window is None or not self.acc:
+            return None
+
+        fields = dict()
+        for name, (vmin, vmax, vsum, n, last) in self.acc.items():
+            if n:
+                fields[name + '_min'] = vmin
+                fields[name + '_max'] = vmax
+                fields[name + '_mean'] = vsum / n
+            fields[name + '_last'] = last
+
+        ret = self.t_window, fields
+        self.acc = dict()
+        return ret
@@ -0,0 +1,390 @@
+#!/usr/bin/python
+#
+# End-to-end benchmark of the polling pipeline: the real PollMainLoop,
+# VitoTronicProtocol and web routes of py-viessmann-log.py run against
+# a fake controller (fake_vitotronic.py) and a local http server that
+# stands in for InfluxDB. Results are appended as one json line to the
+# results file, --compare prints them next to the previous run.
+#
+#   ./benchmarks/bench_pipeline.py --duration 60 --compare
+#
+
+from pathlib import Path
+import argparse
+import asyncio
+import datetime
+import http.server
+import importlib.util
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+TOPDIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(TOPDIR))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+import influxdb_client  # noqa: E402
+
+import fake_vitotronic  # noqa: E402
+import log_util  # noqa: E402
+import stats_util  # noqa: E402
+import viessmann_decode  # noqa: E402
+import vitotronic  # noqa: E402
+
+log = logging.getLogger('bench_pipeline')
+
+
+class LogCounter(logging.Handler):
+    '''Formats every record like the daemon would, but only counts it.'''
+    def __init__(self):
+        super().__init__()
+        self.n_lines = 0
+        self.n_bytes = 0
+
+    def emit(self, record):
+        self.n_lines += 1
+        self.n_bytes += len(self.format(record).encode()) + 1
+
+
+def load_daemon():
+    # the daemon is a script with a dash in its name, import it by path
+    spec = importlib.util.spec_from_file_location(
+        'py_viessmann_log', TOPDIR / 'py-viessmann-log.py')
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def percentiles(values):
+    s = sorted(values)
+    if not s:
+        return {'n': 0}
+    return {
+        'n': len(s),
+        'p50': stats_util.percentile(s, 0.5),
+        'p95': stats_util.percentile(s, 0.95),
+        'max': s[-1],
+    }
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=TOPDIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+###
+# InfluxDB stand-in, runs in its own thread as the daemon writes
+# synchronously from the event loop
+###
+class InfluxSinkHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        n = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(n)
+        srv = self.server
+        with srv.lock:
+            srv.n_writes += 1
+            srv.n_bytes += n
+            srv.n_lines += len(body.splitlines())
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def start_influx_sink():
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), InfluxSinkHandler)
+    srv.lock = threading.Lock()
+    srv.n_writes = srv.n_bytes = srv.n_lines = 0
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def fake_memory(varlist):
+    mem = dict()
+    for k, item in enumerate(varlist):
+        mem[item.addr] = bytes((k + i) & 0xff for i in range(item.length))
+    # the controller clock must decode to a valid date
+    mem[0x088e] = bytes([0x20, 0x26, 0x10, 0x19, 0x02, 0x12, 0x00, 0x00])
+    # answers containing ENQ (0x05), which must not break a resync
+    for item in varlist[:3]:
+        if item.length >= 2 and item.addr != 0x088e:
+            mem[item.addr] = bytes([0x05]) + mem[item.addr][1:]
+    return mem
+
+
+async def web_client(session, base, items, deadline, latencies):
+    loop = asyncio.get_running_loop()
+    k = 0
+    while loop.time() < deadline:
+        route = ['query', 'batch', 'sensor', 'stats'][k % 4]
+        k += 1
+        t0 = loop.time()
+        if route == 'query':
+            addr, tag = items[k % len(items)]
+            req = session.get(f'{base}/query/{addr}/{tag}')
+        elif route == 'batch':
+            req = session.post(f'{base}/query', json=items)
+        else:
+            req = session.get(f'{base}/{route}')
+        async with req as resp:
+            await resp.read()
+            ok = resp.status == 200
+        latencies.setdefault(route if ok else route + '_err',
+                             list()).append(loop.time() - t0)
+
+
+async def run(args, log_counter):
+    loop = asyncio.get_running_loop()
+    daemon = load_daemon()
+
+    dargs = daemon.make_parser().parse_args(
+        ['-s', '0', '-B', str(args.batch_submit)] +
+        (['--link-latency', str(1e-3 * args.net_latency)] if args.tcp else []) +
+        (['--log-summary'] if args.log_summary else []) +
+        [str(args.variables)])
+    varlist = viessmann_decode.load_variable_list(dargs.variablelist)
+
+    sink = start_influx_sink()
+    influx = influxdb_client.InfluxDBClient(
+        url='http://127.0.0.1:%d/' % sink.server_address[1], token='bench')
+
+    controller = fake_vitotronic.FakeVitotronic(
+        loop, fake_memory(varlist), latency=1e-3 * args.latency,
+        nak_rate=args.nak_rate, drop_rate=args.drop_rate,
+        junk_rate=args.junk_rate)
+    if args.tcp:
+        bridges = list()
+        server = await loop.create_server(
+            lambda: fake_vitotronic.FakeBridge(
+                loop, controller, 1e-3 * args.net_latency / 2, bridges),
+            '127.0.0.1', 0)
+        proto = vitotronic.VitoTronicProtocol()
+        link_task = loop.create_task(vitotronic.TcpLink(
+            proto, '127.0.0.1', server.sockets[0].getsockname()[1],
+            min_backoff=0.1).run())
+        if args.tcp_drop > 0:
+            async def drop():
+                while True:
+                    await asyncio.sleep(args.tcp_drop)
+                    for b in list(bridges):
+                        b.transport.close()
+            drop_task = loop.create_task(drop())
+    else:
+        transport, proto = fake_vitotronic.create_fake_connection(
+            loop, vitotronic.VitoTronicProtocol, controller)
+    while proto.rx_state != proto._rx_state_sync:
+        await asyncio.sleep(0.05)
+
+    pm = daemon.PollMainLoop(proto, influx, varlist, dargs)
+
+    ###
+    # phase 1: poll only
+    ###
+    rss_start = rss_bytes()
+    cpu_start = time.process_time()
+    log_start = log_counter.n_lines, log_counter.n_bytes
+    t_start = loop.time()
+    poll_task = loop.create_task(pm.tick())
+    await asyncio.sleep(args.duration)
+    cpu = time.process_time() - cpu_start
+    elapsed = loop.time() - t_start
+    rss_end = rss_bytes()
+    log_lines = log_counter.n_lines - log_start[0]
+    log_bytes = log_counter.n_bytes - log_start[1]
+
+    n_samples = sum(st['ok'] for st in pm.timing.as_dict().values())
+    cycles = list(pm.cycle_times)
+    poll = {
+        'cycles': len(cycles),
+        'cycle_s': percentiles(cycles),
+        'samples': n_samples,
+        'samples_per_s': n_samples / elapsed,
+        'cpu_per_sample_us': 1e6 * cpu / n_samples if n_samples else None,
+        'cpu_frac': cpu / elapsed,
+        'rss_start': rss_start,
+        'rss_growth': rss_end - rss_start,
+        'variables': pm.timing.as_dict(),
+        'influx': {'writes': sink.n_writes, 'lines': sink.n_lines,
+                   'bytes': sink.n_bytes},
+        'log': {'lines': log_lines, 'bytes': log_bytes},
+    }
+
+    ###
+    # phase 2: concurrent web load while polling continues
+    ###
+    runner = web.AppRunner(daemon.make_webapp(pm))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = 'http://127.0.0.1:%d' % runner.addresses[0][1]
+
+    items = [['%04x' % it.addr, str(it.length)] for it in varlist[:6]]
+    latencies = dict()
+    n_cycles = len(pm.cycle_times)
+    deadline = loop.time() + args.web_duration
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[
+            web_client(session, base, items, deadline, latencies)
+            for _ in range(args.clients)])
+
+    webres = {route: percentiles(v) for route, v in latencies.items()}
+    webres['requests_per_s'] = sum(
+        len(v) for v in latencies.values()) / args.web_duration
+    webres['errors_per_s'] = sum(
+        len(v) for route, v in latencies.items()
+        if route.endswith('_err')) / args.web_duration
+    for route in ('query', 'batch', 'sensor', 'stats'):
+        n_ok = len(latencies.get(route, ()))
+        n_err = len(latencies.get(route + '_err', ()))
+        webres[route + '_err_frac'] = n_err / (n_ok + n_err) if n_ok + n_err else None
+    webres['cycle_s'] = percentiles(list(pm.cycle_times)[n_cycles:])
+    webres['bus'] = pm.bus.as_dict()
+
+    link = proto.link_stats()
+
+    poll_task.cancel()
+    await runner.cleanup()
+    if args.tcp:
+        if args.tcp_drop > 0:
+            drop_task.cancel()
+        link_task.cancel()
+        if proto.transport:
+            proto.transport.close()
+        server.close()
+    else:
+        transport.close()
+    sink.shutdown()
+
+    summary = {
+        'cycle_p50_s': poll['cycle_s'].get('p50'),
+        'cycle_p95_s': poll['cycle_s'].get('p95'),
+        'cpu_per_sample_us': poll['cpu_per_sample_us'],
+        'rss_growth_kb': poll['rss_growth'] / 1024,
+        'log_bytes_per_s': log_bytes / elapsed,
+        'web_query_p95_s': webres.get('query', {}).get('p95'),
+        'web_batch_p95_s': webres.get('batch', {}).get('p95'),
+        'web_sensor_p95_s': webres.get('sensor', {}).get('p95'),
+        'web_requests_per_s': webres['requests_per_s'],
+        'web_errors_per_s': webres['errors_per_s'],
+        'web_query_err_frac': webres['query_err_frac'],
+        'web_batch_err_frac': webres['batch_err_frac'],
+        'web_sensor_err_frac': webres['sensor_err_frac'],
+        'web_cycle_p95_s': webres['cycle_s'].get('p95'),
+        'resyncs': link['resyncs'],
+        'resync_p50_s': link['resync']['p50'],
+        'handshakes': link['handshake']['n'],
+        'connects': link['connects'],
+    }
+
+    return {
+        'time': datetime.datetime.now().astimezone().isoformat(),
+        'version': git_version(),
+        'label': args.label,
+        'params': {k: (str(v) if isinstance(v, Path) else v)
+                   for k, v in vars(args).items()},
+        'summary': summary,
+        'poll': poll,
+        'web': webres,
+        'link': link,
+    }
+
+
+def compare(prev, cur):
+    print('%-22s %14s %14s %8s' % ('', prev['version'], cur['version'], ''))
+    for k, v in cur['summary'].items():
+        pv = prev['summary'].get(k)
+        if v is None or pv is None:
+            print('%-22s %14s %14s' % (k, pv, v))
+            continue
+        change = '%+7.1f%%' % (100 * (v - pv) / pv) if pv else ''
+        print('%-22s %14.6g %14.6g %8s' % (k, pv, v, change))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', metavar='SEC', type=float, default=30,
+                        help='Length of the poll-only phase. [def: %(default)s]')
+    parser.add_argument('-W', '--web-duration', metavar='SEC', type=float, default=15,
+                        help='Length of the web load phase. [def: %(default)s]')
+    parser.add_argument('-c', '--clients', metavar='N', type=int, default=8,
+                        help='Concurrent web clients. [def: %(default)d]')
+    parser.add_argument('-l', '--latency', metavar='MS', type=float, default=20,
+                        help='Controller answer latency. [def: %(default)s]')
+    parser.add_argument('--nak-rate', metavar='P', type=float, default=0.0,
+                        help='Probability of a NAK per read. [def: %(default)s]')
+    parser.add_argument('--drop-rate', metavar='P', type=float, default=0.0,
+                        help='Probability of no answer per read. [def: %(default)s]')
+    parser.add_argument('--junk-rate', metavar='P', type=float, default=0.0,
+                        help='Probability of line noise before an answer. [def: %(default)s]')
+    parser.add_argument('--tcp', action='store_true',
+                        help='Talk to the fake controller through a local tcp bridge.')
+    parser.add_argument('--net-latency', metavar='MS', type=float, default=0,
+                        help='With --tcp, round-trip time added by the bridge. [def: %(default)s]')
+    parser.add_argument('--tcp-drop', metavar='SEC', type=float, default=0,
+                        help='With --tcp, drop the connection every SEC seconds. [def: off]')
+    parser.add_argument('-B', '--batch-submit', metavar='N', type=int, default=5,
+                        help='Daemon batch size for InfluxDB writes. [def: %(default)d]')
+    parser.add_argument('-V', '--variables', metavar='FILE', type=Path,
+                        default=TOPDIR / 'viessmann_variables.txt',
+                        help='Variable list. [def: %(default)s]')
+    parser.add_argument('-r', '--results', metavar='FILE', type=Path,
+                        default=TOPDIR / 'benchmarks' / 'results.jsonl',
+                        help='Append results to FILE. [def: %(default)s]')
+    parser.add_argument('--label', metavar='TXT', default='',
+                        help='Free text stored with the results.')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare with the previous run in the results file.')
+    parser.add_argument('--log-level', default='warning',
+                        choices=['debug', 'info', 'warning'],
+                        help='Daemon log level, the log is formatted and counted. [def: %(default)s]')
+    parser.add_argument('--log-summary', action='store_true',
+                        help='Run the daemon with --log-summary.')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Show the daemon log.')
+    args = parser.parse_args()
+
+    log_counter = LogCounter()
+    handlers = [log_counter]
+    if args.verbose:
+        handlers.append(logging.StreamHandler())
+    logging.basicConfig(level=args.log_level.upper(), handlers=handlers,
+                        format='%(asctime)-15s %(message)s')
+    log_util.add_rate_limit(60)
+
+    res = asyncio.run(run(args, log_counter))
+
+    prev = None
+    if args.results.exists():
+        lines = args.results.read_text().splitlines()
+        if lines:
+            prev = json.loads(lines[-1])
+    with args.results.open('a') as f:
+        f.write(json.dumps(res) + '\n')
+
+    if args.compare and prev:
+        compare(prev, res)
+    else:
+        print(json.dumps(res['summary'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
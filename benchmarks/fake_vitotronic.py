@@ -0,0 +1,177 @@
+#!/usr/bin/python
+#
+# Stand-in for a Vitotronic controller behind an Optolink adapter, it
+# speaks just enough of the protocol for VitoTronicProtocol: ENQ while
+# unsynced, ACK for the sync sequence and answers to read requests.
+# Timing follows a 4800 baud 8E2 line plus a fixed controller latency.
+# FakeBridge serves it over tcp like a ser2net bridge would.
+#
+
+import asyncio
+import random
+
+from ascii_tbl import ACK_i, NAK_i, ENQ_i, EOT_i
+from vitotronic import SYNC_MSG
+
+BYTE_TIME = 12 / 4800  # start + 8 data + parity + 2 stop bits
+
+
+class FakeVitotronic:
+    def __init__(self, loop, memory=None, latency=0.02, byte_time=BYTE_TIME,
+                 enq_interval=0.1, nak_rate=0.0, drop_rate=0.0, junk_rate=0.0):
+        self.loop = loop
+        self.memory = dict() if memory is None else memory  # addr -> bytes
+        self.latency = latency
+        self.byte_time = byte_time
+        self.enq_interval = enq_interval
+        self.nak_rate = nak_rate
+        self.drop_rate = drop_rate
+        self.junk_rate = junk_rate  # line noise before an answer
+
+        self.deliver = None
+        self.enq_task = None
+        self.synced = False
+        self.rx = bytearray()
+        self.n_requests = 0
+        self.t_busy = 0.0  # time the line will be free again
+
+    def attach(self, deliver):
+        self.deliver = deliver
+        if self.enq_task is None:
+            self.enq_task = self.loop.create_task(self._enq_loop())
+
+    async def _enq_loop(self):
+        while True:
+            if not self.synced:
+                self._send(bytes([ENQ_i]), 0.0)
+            await asyncio.sleep(self.enq_interval)
+
+    def _send(self, data, delay):
+        # the answer can only start when the previous one is on the wire
+        now = self.loop.time()
+        t_start = max(now + delay, self.t_busy)
+        self.t_busy = t_start + len(data) * self.byte_time
+        self.loop.call_at(self.t_busy, self.deliver, bytes(data))
+
+    def read_memory(self, addr, length):
+        ret = bytearray()
+        for a in range(addr, addr + length):
+            for start, data in self.memory.items():
+                if start <= a < start + len(data):
+                    ret.append(data[a - start])
+                    break
+            else:
+                ret.append(0)
+        return ret
+
+    def received(self, data):
+        self.rx += data
+        while self.rx:
+            if self.rx.startswith(SYNC_MSG):
+                del self.rx[:len(SYNC_MSG)]
+                self.synced = True
+                self._send(bytes([ACK_i]), self.latency)
+                continue
+            if self.rx[0] == 0x41:
+                if len(self.rx) < 2 or len(self.rx) < self.rx[1] + 3:
+                    return
+                telegram = bytes(self.rx[:self.rx[1] + 3])
+                del self.rx[:len(telegram)]
+                self._handle(telegram)
+                continue
+            if self.rx[0] == EOT_i:
+                self.synced = False  # back to ENQ until the next sync
+            del self.rx[:1]  # anything else we do not care about
+
+    def _handle(self, telegram):
+        t_rx = len(telegram) * self.byte_time
+        if not self.synced:
+            return
+        if sum(telegram[1:-1]) & 0xff != telegram[-1] or telegram[2:4] != b'\x00\x01':
+            self._send(bytes([NAK_i]), t_rx + self.latency)
+            return
+
+        self.n_requests += 1
+        if random.random() < self.nak_rate:
+            self._send(bytes([NAK_i]), t_rx + self.latency)
+            return
+        if random.random() < self.drop_rate:
+            return
+
+        length = telegram[6]
+        answer = bytearray(telegram[:7])
+        answer[1] = 5 + length
+        answer[2] = 1  # answer
+        answer += self.read_memory((telegram[4] << 8) | telegram[5], length)
+        answer.append(sum(answer[1:]) & 0xff)
+        junk = b''
+        if random.random() < self.junk_rate:
+            junk = bytes(random.randrange(256) for i in range(random.randint(1, 4)))
+        self._send(junk + bytes([ACK_i]) + answer, t_rx + self.latency)
+
+
+class _FakeSerial:
+    def __init__(self, port):
+        self.port = port
+
+
+class FakeSerialTransport(asyncio.Transport):
+    def __init__(self, loop, controller, protocol, port='fake'):
+        super().__init__()
+        self._loop = loop
+        self._serial = _FakeSerial(port)
+        self._protocol = protocol
+        self._controller = controller
+        self._closing = False
+        controller.attach(self._deliver)
+
+    def _deliver(self, data):
+        if not self._closing:
+            self._protocol.data_received(data)
+
+    def write(self, data):
+        self._controller.received(data)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._closing = True
+
+
+class FakeBridge(asyncio.Protocol):
+    '''One tcp connection to the controller, with delay added each way.'''
+    def __init__(self, loop, controller, delay=0.0, connections=None):
+        self.loop = loop
+        self.controller = controller
+        self.delay = delay
+        self.connections = connections  # list of open bridges, for tests
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.controller.attach(self._deliver)
+        if self.connections is not None:
+            self.connections.append(self)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.connections is not None:
+            self.connections.remove(self)
+
+    def _write(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+
+    def _deliver(self, data):
+        self.loop.call_later(self.delay, self._write, data)
+
+    def data_received(self, data):
+        self.loop.call_later(self.delay, self.controller.received, data)
+
+
+def create_fake_connection(loop, protocol_factory, controller):
+    proto = protocol_factory()
+    transport = FakeSerialTransport(loop, controller, proto)
+    proto.connection_made(transport)
+    return transport, proto
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+import asyncio
+import collections
+import contextlib
+import logging
+
+import stats_util
+
+log = logging.getLogger('bus_arbiter')
+
+###
+# priority classes, lower number wins
+###
+INTERACTIVE = 0  # web queries
+SCHEDULED = 1  # regular poll of the variable list
+BACKGROUND = 2  # scans, prefetch, ...
+
+CLASS_NAMES = ['interactive', 'scheduled', 'background']
+
+# (rate [1/s], burst) per class, None: unlimited
+DEFAULT_LIMITS = {
+    INTERACTIVE: (2.0, 10),
+    SCHEDULED: None,
+    BACKGROUND: (1.0, 2),
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t_last = None
+
+    def refill(self, now):
+        if self.t_last is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.t_last) * self.rate)
+        self.t_last = now
+
+    def available(self, now):
+        self.refill(now)
+        return self.tokens >= 1.0
+
+    def take(self, now, cost=1):
+        # may go negative, an expensive transaction has to be paid back
+        self.refill(now)
+        self.tokens -= cost
+
+    def refund(self, cost):
+        self.tokens = min(self.burst, self.tokens + cost)
+
+
+class WaitStats:
+    def __init__(self, nsamples=256):
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = collections.deque(maxlen=nsamples)
+
+    def add(self, t):
+        self.n += 1
+        self.total += t
+        self.max = max(self.max, t)
+        self.recent.append(t)
+
+    def as_dict(self):
+        s = sorted(self.recent)
+        return {
+            'n': self.n,
+            'mean': self.total / self.n if self.n else None,
+            'max': self.max,
+            'p50': stats_util.percentile(s, 0.5),
+            'p95': stats_util.percentile(s, 0.95),
+        }
+
+
+#
+# The arbiter hands out the bus to one transaction at a time, when the bus
+# is released the waiter of the highest priority class gets it. A class
+# with a rate limit has to wait for a token in its bucket before it even
+# queues up. As the regular poll takes the bus per variable, an
+# interactive request does not wait behind a whole poll cycle, only for
+# the slot holding the bus (one variable, or a chunk of a batch query),
+# while a burst of interactive requests runs out of tokens and cannot
+# starve the poll.
+# Background work only gets the bus if nobody else waits. One request is
+# charged at most a full burst, and the tokens are refunded if it gives up
+# before getting the bus.
+#
+
+class BusArbiter:
+    def __init__(self, limits=None):
+        if limits is None:
+            limits = DEFAULT_LIMITS
+        self.buckets = dict()
+        for prio, lim in limits.items():
+            if lim is not None:
+                self.buckets[prio] = TokenBucket(*lim)
+
+        self.busy = False
+        self.waiters = [collections.deque() for _ in CLASS_NAMES]
+        self.wait_stats = [WaitStats() for _ in CLASS_NAMES]
+
+    async def acquire(self, prio, cost=1):
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+
+        # cost 0: continuation of a transaction that has already paid
+        bucket = self.buckets.get(prio) if cost > 0 else None
+        if bucket is not None:
+            cost = min(cost, bucket.burst)
+            while not bucket.available(loop.time()):
+                await asyncio.sleep((1.0 - bucket.tokens) / bucket.rate)
+            bucket.take(loop.time(), cost)
+
+        if not self.busy and not any(self.waiters):
+            self.busy = True
+            self.wait_stats[prio].add(loop.time() - t0)
+            return
+
+        fut = loop.create_future()
+        self.waiters[prio].append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # bus was already handed to us
+            elif fut in self.waiters[prio]:
+                self.waiters[prio].remove(fut)
+            if bucket is not None:
+                bucket.refund(cost)  # never used the bus
+            raise
+        self.wait_stats[prio].add(loop.time() - t0)
+
+    def release(self):
+        # a waiter cancelled since it queued (e.g. by its timeout) may not
+        # have run yet to remove itself, skip it
+        for q in self.waiters:
+            while q:
+                fut = q.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+                    return
+        self.busy = False
+
+    @contextlib.asynccontextmanager
+    async def slot(self, prio, timeout=None, cost=1):
+        '''Hold the bus for one transaction of the given priority class.
+
+        cost is the number of bus transactions done while holding the
+        slot, it is charged to the class' token bucket (at most one burst,
+        0 for the further slots of a transaction split up). Raises
+        asyncio.TimeoutError if the bus could not be acquired within
+        timeout seconds.
+        '''
+        if timeout is None:
+            await self.acquire(prio, cost)
+        else:
+            await asyncio.wait_for(self.acquire(prio, cost), timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def as_dict(self):
+        return {name: dict(self.wait_stats[prio].as_dict(),
+                           queued=len(self.waiters[prio]))
+                for prio, name in enumerate(CLASS_NAMES)}
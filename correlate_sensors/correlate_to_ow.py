@@ -19,6 +19,39 @@ def linspace_min_max_grow(ndarr, grow):
     return np.linspace(x1, x2, 100)
 
 
+def resample_uniform(t, y, t_start, t_end, dt):
+    grid = np.arange(t_start, t_end, dt)
+    return grid, np.interp(grid, t, y)
+
+
+def xcorr_lag(a, b, dt, max_lag):
+    # Lag of b relative to a (positive: b lags behind a) which maximizes the
+    # cross correlation of the two equally sampled series. The correlation
+    # for all lags is computed at once by FFT, zero padded to avoid
+    # wrap-around. Returns lag in seconds and the normalized correlation.
+    a = a - np.mean(a)
+    b = b - np.mean(b)
+    n = len(a)
+    nfft = 1 << (2 * n - 1).bit_length()
+    cc = np.fft.irfft(np.conj(np.fft.rfft(a, nfft)) * np.fft.rfft(b, nfft), nfft)
+
+    # cc[k] = sum(a[i] * b[i+k]), negative k wrap around to the end
+    max_k = min(n - 1, int(max_lag / dt))
+    vals = np.concatenate((cc[nfft - max_k:], cc[:max_k + 1]))
+    i = int(np.argmax(vals))
+
+    # refine peak position by fitting a parabola through its neighbours
+    frac = 0.0
+    if 0 < i < len(vals) - 1:
+        y0, y1, y2 = vals[i - 1], vals[i], vals[i + 1]
+        denom = y0 - 2 * y1 + y2
+        if denom != 0:
+            frac = 0.5 * (y0 - y2) / denom
+
+    norm = np.sqrt(np.sum(a * a) * np.sum(b * b))
+    return (i - max_k + frac) * dt, vals[i] / norm if norm else 0.0
+
+
 def query_to_np(clt, query):
     print(f'Runing query "{query}".')
     res = clt.query(query)
@@ -45,6 +78,10 @@ parser.add_argument('-i', '--influx-host', default='127.0.0.1', metavar='HOST',
                     help='Influx host [127.0.0.1]')
 parser.add_argument('-u', '--unit', dest='unit', metavar='UNIT', default='arb',
                     help='Unit of measurement, e.g. volt, degC, ... [def: arb]')
+parser.add_argument('-l', '--max-lag', metavar='SEC', type=float, default=1800,
+                    help='Search lag of series 2 up to +/- SEC, 0: assume no lag [def: 1800]')
+parser.add_argument('-g', '--grid', metavar='SEC', type=float, default=None,
+                    help='Resample to SEC for lag search [def: median step of series 1]')
 parser.add_argument(metavar='measurement1:column1', dest='mc1')
 parser.add_argument(metavar='measurement2:column2', dest='mc2')
 
@@ -66,18 +103,29 @@ if args.end:
         query += f" WHERE time <= '{args.end}'"
 
 t1, val1 = query_to_np(clt, query)
-t1_rel = (t1 - t1[0]).astype('f') / 1e9
+t1_rel = (t1 - t1[0]).astype('d') / 1e9
 
 t_min_str = str(np.amin(t1)) + 'Z'
 t_max_str = str(np.amax(t1)) + 'Z'
 
 t2, val2 = query_to_np(clt, f"SELECT {col2} FROM {m2} WHERE time >= '{t_min_str}' AND time <= '{t_max_str}'")
-t2_rel = (t2 - t1[0]).astype('f') / 1e9
+t2_rel = (t2 - t1[0]).astype('d') / 1e9
 
 print('Minimum timestamp:', np.amin(t1), np.amin(t2))
 print('Maximum timestamp:', np.amax(t1), np.amax(t2))
 
-val2_on_t1 = np.interp(t1_rel, t2_rel, val2)
+lag = 0.0
+if args.max_lag > 0:
+    dt = args.grid or float(np.median(np.diff(t1_rel)))
+    t_start = max(t1_rel[0], t2_rel[0])
+    t_end = min(t1_rel[-1], t2_rel[-1])
+    grid, val1_grid = resample_uniform(t1_rel, val1, t_start, t_end, dt)
+    grid, val2_grid = resample_uniform(t2_rel, val2, t_start, t_end, dt)
+    lag, corr = xcorr_lag(val1_grid, val2_grid, dt, args.max_lag)
+    print(f'Lag of {col2} behind {col1}: {lag:.1f} s (grid {dt:.1f} s, correlation {corr:.3f})')
+
+# value of series 2 that corresponds to series 1 at each timestamp
+val2_on_t1 = np.interp(t1_rel + lag, t2_rel, val2)
 poly = np.polyfit(val1, val2_on_t1, 1)
 print('Polyfit:', poly)
 
@@ -89,6 +137,8 @@ ax.set_xlabel('Time [s]')
 ax.set_ylabel('Temp [degC]')
 ax.plot(t1_rel, val1, label=col1)
 ax.plot(t2_rel, val2, label=col2)
+if lag:
+    ax.plot(t2_rel - lag, val2, label=f'{col2} shifted by {-lag:.0f} s')
 ax.legend()
 fig.savefig('time_series.png')
 
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+#
+# NTC thermistor conversion resistance -> temperature for whole numpy
+# arrays, from a Steinhart-Hart or beta fit of a datasheet table like
+# meas_spec_k10k3435.txt (lines "<degC> <kOhm>"), or by interpolating
+# the table itself.
+#
+# The fitted closed forms are a single vectorized pass (one log, a few
+# multiply-adds) and were measured faster than a precomputed lookup table
+# with np.interp, which has to binary search every value.
+#
+
+import argparse
+import time
+
+import numpy as np
+
+T_ZERO = 273.15
+
+
+def load_table(fn):
+    '''Returns (temperature in degC, resistance in Ohm), sorted by temperature.'''
+    tbl = np.loadtxt(fn, comments='#', ndmin=2)
+    tbl = tbl[np.argsort(tbl[:, 0])]
+    return tbl[:, 0], tbl[:, 1] * 1e3
+
+
+def fit_steinhart_hart(t, r):
+    '''Least squares fit of 1/T = a + b ln(R) + c ln(R)^3, returns (a, b, c).'''
+    ln_r = np.log(r)
+    m = np.column_stack((np.ones_like(ln_r), ln_r, ln_r ** 3))
+    coeffs, *_ = np.linalg.lstsq(m, 1.0 / (np.asarray(t) + T_ZERO), rcond=None)
+    return tuple(coeffs)
+
+
+def fit_beta(t, r, t0=25.0):
+    '''Least squares fit of ln(R) = ln(R0) + beta (1/T - 1/T0), returns (r0, beta).'''
+    x = 1.0 / (np.asarray(t) + T_ZERO) - 1.0 / (t0 + T_ZERO)
+    beta, ln_r0 = np.polyfit(x, np.log(r), 1)
+    return np.exp(ln_r0), beta
+
+
+def steinhart_hart(r, a, b, c):
+    '''Temperature in degC for resistances r (Ohm).'''
+    ln_r = np.log(r)
+    return 1.0 / (a + ln_r * (b + c * ln_r * ln_r)) - T_ZERO
+
+
+def beta_temperature(r, r0, beta, t0=25.0):
+    '''Temperature in degC for resistances r (Ohm).'''
+    return 1.0 / (1.0 / (t0 + T_ZERO) + np.log(np.asarray(r) / r0) / beta) - T_ZERO
+
+
+def table_temperature(r, t_tbl, r_tbl):
+    '''Temperature in degC by interpolating 1/T linearly in ln(R) between
+    table points, NaN outside of the table.'''
+    ln_r_tbl = np.log(r_tbl)
+    order = np.argsort(ln_r_tbl)
+    inv_t = 1.0 / (np.asarray(t_tbl) + T_ZERO)
+    inv = np.interp(np.log(r), ln_r_tbl[order], inv_t[order],
+                    left=np.nan, right=np.nan)
+    return 1.0 / inv - T_ZERO
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--tolerance', help='Max. deviation from the table in K. [def: %(default)s]',
+                        metavar='K', type=float, default=0.05)
+    parser.add_argument('-n', '--bench', help='Time conversion of N random readings. [def: %(default)d]',
+                        metavar='N', type=int, default=1000000)
+    parser.add_argument('table', help='Table with lines "<degC> <kOhm>"',
+                        nargs='?', default='meas_spec_k10k3435.txt')
+    args = parser.parse_args()
+
+    t_tbl, r_tbl = load_table(args.table)
+
+    sh = fit_steinhart_hart(t_tbl, r_tbl)
+    r0, beta = fit_beta(t_tbl, r_tbl)
+    print('Steinhart-Hart: a=%.6e b=%.6e c=%.6e' % sh)
+    print('Beta: R25=%.1f Ohm beta=%.1f K' % (r0, beta))
+
+    ok = True
+    for name, t_fit in (('Steinhart-Hart', steinhart_hart(r_tbl, *sh)),
+                        ('Beta', beta_temperature(r_tbl, r0, beta))):
+        err = t_fit - t_tbl
+        i = np.argmax(np.abs(err))
+        print('%s: max error %.3f K at %g degC, rms %.3f K' %
+              (name, err[i], t_tbl[i], np.sqrt(np.mean(err ** 2))))
+        if name == 'Steinhart-Hart' and abs(err[i]) > args.tolerance:
+            ok = False
+
+    if args.bench:
+        r = np.random.uniform(r_tbl.min(), r_tbl.max(), args.bench)
+        for name, fn in (('Steinhart-Hart', lambda: steinhart_hart(r, *sh)),
+                         ('Beta', lambda: beta_temperature(r, r0, beta)),
+                         ('Table', lambda: table_temperature(r, t_tbl, r_tbl))):
+            t0 = time.perf_counter()
+            fn()
+            dt = time.perf_counter() - t0
+            print('%s: %d readings in %.3f s' % (name, args.bench, dt))
+
+    if not ok:
+        print('Steinhart-Hart fit exceeds tolerance of %.3f K' % args.tolerance)
+        raise SystemExit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# Rolling-window values derived from the polled variables, updated at
+# constant cost per sample:
+#
+#   delta   sum of the increments of a counter over the window
+#   rate    increments of a counter per second over the window
+#   twmean  time weighted mean over the window
+#
+# Counters are unsigned 32 bit values from the controller, a decrease is
+# either a wrap-around (close to 2**32 before, small now) or a reset.
+#
+
+import collections
+import logging
+
+log = logging.getLogger('derived_metrics')
+
+DerivedMetricSpec = collections.namedtuple('DerivedMetricSpec',
+                                           ['name', 'kind', 'source', 'window'])
+
+
+class CounterDelta:
+    def __init__(self, bits=32):
+        self.modulo = 1 << bits
+        self.last = None
+
+    def update(self, v):
+        last, self.last = self.last, v
+        if last is None:
+            return None
+        if v >= last:
+            return v - last
+        if last - v > self.modulo // 2:
+            return v + self.modulo - last  # wrapped around
+        log.warning('Counter reset from %d to %d.', last, v)
+        return v
+
+
+class WindowSum:
+    def __init__(self, window):
+        self.window = window
+        self.items = collections.deque()  # (t, x)
+        self.sum = 0
+        self.t_first = None  # time the first increment counts from
+
+    def start(self, t):
+        if self.t_first is None:
+            self.t_first = t
+
+    def add(self, t, x):
+        self.start(t)
+        self.items.append((t, x))
+        self.sum += x
+        while self.items and self.items[0][0] <= t - self.window:
+            self.sum -= self.items.popleft()[1]
+
+    def covered(self, t):
+        # length of the window we have data for
+        if self.t_first is None:
+            return 0.0
+        return min(self.window, t - self.t_first)
+
+
+class TimeWeightedMean:
+    def __init__(self, window):
+        self.window = window
+        self.segments = collections.deque()  # (t_start, t_end, v)
+        self.integral = 0.0
+        self.last = None  # (t, v)
+
+    def add(self, t, v):
+        if self.last is not None:
+            t_last, v_last = self.last
+            self.segments.append((t_last, t, v_last))
+            self.integral += v_last * (t - t_last)
+        self.last = (t, v)
+
+        t_win = t - self.window
+        while self.segments and self.segments[0][1] <= t_win:
+            t0, t1, v0 = self.segments.popleft()
+            self.integral -= v0 * (t1 - t0)
+
+    def value(self):
+        if not self.segments:
+            return self.last[1] if self.last else None
+        t_end = self.segments[-1][1]
+        t0, t1, v0 = self.segments[0]
+        t_start = max(t0, t_end - self.window)
+        # first segment may reach back beyond the window
+        integral = self.integral - v0 * (t_start - t0)
+        if t_end <= t_start:
+            return v0
+        return integral / (t_end - t_start)
+
+
+class DerivedMetric:
+    def __init__(self, spec):
+        self.spec = spec
+        self.value = None
+        if spec.kind in ['delta', 'rate']:
+            self.counter = CounterDelta()
+            self.acc = WindowSum(spec.window)
+        elif spec.kind == 'twmean':
+            self.acc = TimeWeightedMean(spec.window)
+        else:
+            raise RuntimeError('Unknown kind of derived metric: %s' % spec.kind)
+
+    def update(self, t, v):
+        if self.spec.kind == 'twmean':
+            self.acc.add(t, v)
+            self.value = self.acc.value()
+            return
+
+        delta = self.counter.update(v)
+        if delta is None:
+            # the first increment covers the time since this sample
+            self.acc.start(t)
+            return
+        self.acc.add(t, delta)
+        if self.spec.kind == 'delta':
+            self.value = self.acc.sum
+        else:
+            covered = self.acc.covered(t)
+            self.value = self.acc.sum / covered if covered > 0 else None
+
+
+class DerivedMetrics:
+    def __init__(self, specs):
+        self.metrics = [DerivedMetric(spec) for spec in specs]
+        self.by_source = collections.defaultdict(list)
+        for m in self.metrics:
+            self.by_source[m.spec.source].append(m)
+
+    def update(self, source, t, v):
+        for m in self.by_source.get(source, []):
+            m.update(t, v)
+
+    def values(self):
+        return {m.spec.name: m.value for m in self.metrics
+                if m.value is not None}
+
+
+def load_derived_metrics(fn):
+    ret = list()
+
+    with open(fn, 'rt') as f:
+        for lno, line in enumerate(f, 1):
+            ix = line.find('#')
+            if ix != -1:
+                line = line[:ix]
+            line = line.strip()
+
+            if not line:
+                continue
+
+            arr = line.split()
+            if len(arr) != 4:
+                raise RuntimeError(
+                    '%s:%d need 4 columns: name kind source window' % (fn, lno))
+
+            spec = DerivedMetricSpec(arr[0], arr[1], arr[2], float(arr[3]))
+            if spec.kind not in ['delta', 'rate', 'twmean']:
+                raise RuntimeError('%s:%d unknown kind %s' % (fn, lno, spec.kind))
+            ret.append(spec)
+
+    return ret
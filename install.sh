@@ -15,9 +15,13 @@ install -v -m755 -o0 -g0 snmp-to-influx.py $libdir
 install -v -m644 -o0 -g0 ow_temp_sensors.txt $libdir
 install -v -m755 -o0 -g0 onewire-log.py $libdir
 
-install -v -m644 -o0 -g0 viessmann_variables.txt $libdir
+install -v -m644 -o0 -g0 viessmann_variables.txt derived_metrics.txt $libdir
 install -v -m755 -o0 -g0 py-viessmann-log.py $libdir
-install -v -m644 -o0 -g0 ascii_tbl.py viessmann_decode.py vitotronic.py \
+install -v -m755 -o0 -g0 join-to-influx.py $libdir
+install -v -m644 -o0 -g0 aggregate.py ascii_tbl.py bus_arbiter.py derived_metrics.py \
+	log_util.py loop_monitor.py online_calib.py poll_schedule.py prefetch.py \
+	publisher.py stats_util.py time_join.py tsstore.py viessmann_decode.py vitotronic.py \
+	web_frontend.py \
 	$libdir/venv/lib/python3.*/site-packages/
 
 if [ -d /etc/systemd/system ] ; then
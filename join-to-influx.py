@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#
+# Subscribe to the samples published by py-viessmann-log.py, onewire-log.py
+# and snmp-to-influx.py (option -P) and write them as one point per tick
+# with all fields of all sources, see time_join.py. Optionally keeps a
+# running calibration of sensor pairs on the joined stream, see
+# online_calib.py. Started with -i - the sources only publish, so the
+# joined point replaces their own points instead of adding to them.
+#
+import influxdb_client
+import asyncio
+import datetime
+import argparse
+import time
+from pathlib import Path
+
+import online_calib
+import publisher
+import time_join
+
+
+class SampleReceiver(asyncio.DatagramProtocol):
+    def __init__(self, joiner, sources, lan=False):
+        self.joiner = joiner
+        self.sources = sources
+        self.lan = lan
+
+    def datagram_received(self, data, addr):
+        if not self.lan and not publisher.is_local(addr[0]):
+            return
+        try:
+            msg = publisher.cbor_decode(data)
+            src = msg['src']
+            if self.sources and src not in self.sources:
+                return
+            self.joiner.add(src, 1e-9 * msg['t'], msg['v'], msg.get('tags'))
+        except Exception as exc:
+            print(f'Cannot decode datagram from {addr[0]}: {repr(exc)}')
+
+
+def parse_pair(s):
+    x_name, sep, y_name = s.partition(':')
+    if not sep or not x_name or not y_name:
+        raise argparse.ArgumentTypeError(f'{s!r} is not x_field:y_field')
+    return x_name, y_name
+
+
+async def mainloop(args, clt, joiner, calib):
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(
+        lambda: SampleReceiver(joiner, args.source, args.publish_lan),
+        sock=publisher.subscribe(args.publish))
+
+    dpts = list()
+    while True:
+        t_tick = joiner.next_tick(time.time())
+        await asyncio.sleep(t_tick - time.time())
+
+        fields = joiner.tick(t_tick)
+        if not fields:
+            continue
+
+        if calib is not None:
+            calib.update(fields)
+            fields.update(calib.fields())
+
+        js_body = {
+            'measurement': args.influxdb_measurement,
+            'time': datetime.datetime.fromtimestamp(t_tick, datetime.timezone.utc),
+            'fields': fields
+        }
+        dpts.append(influxdb_client.Point.from_dict(
+            js_body, influxdb_client.WritePrecision.NS))
+
+        if len(dpts) >= args.batchsize:
+            try:
+                wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
+                write_api = clt.write_api(wr_opts)
+                write_api.write(args.influxdb_bucket, args.influxdb_org, dpts)
+                dpts.clear()
+            except Exception as exc:
+                print(f'Exception {repr(exc)} writing to influxdb!')
+
+            if calib is not None:
+                for key, fit in calib.as_dict().items():
+                    print(f'{key}: ' + ' '.join(f'{k}={v:.4g}' for k, v in fit.items()))
+                if args.calib_state:
+                    try:
+                        calib.save(args.calib_state)
+                    except OSError as exc:
+                        print(f'Cannot save calibration state: {repr(exc)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--influxdb-url', help='Influxdb host. [def: %(default)s]',
+                        metavar='host', type=str, default='http://127.0.0.1:8086/')
+    parser.add_argument('-o', '--influxdb-org', help='Influxdb org. [def: %(default)s]',
+                        metavar='org', type=str, default='vogel.cx')
+    parser.add_argument('-b', '--influxdb-bucket', help='Influxdb bucket. [def: %(default)s]',
+                        metavar='db', type=str, default='heating/autogen')
+    parser.add_argument('-m', '--influxdb-measurement', help='Measurement. [def: %(default)s]',
+                        metavar='txt', type=str, default='joined')
+    parser.add_argument('-T', '--influxdb-token-file', help='Token file',
+                        metavar='file', type=Path)
+    parser.add_argument('-B', '--batchsize', help='Batch insert every N points. [def: %(default)d]',
+                        metavar='N', type=int, default=5)
+    parser.add_argument('-c', '--cadence', help='One point every SEC seconds. [def: %(default)s]',
+                        metavar='SEC', type=float, default=60)
+    parser.add_argument('-S', '--max-age', help='Drop values older than SEC at a tick. [def: 2 * cadence]',
+                        metavar='SEC', type=float, default=None)
+    parser.add_argument('-s', '--source', help='Only join this source (measurement name), may be repeated. [def: all]',
+                        metavar='src', action='append', default=[])
+    parser.add_argument('-P', '--publish', help='Multicast group the samples are published on. [def: %(default)s]',
+                        metavar='GROUP:PORT', default=publisher.DEFAULT_ADDR)
+    parser.add_argument('--publish-lan', action='store_true',
+                        help='Also join samples other hosts publish on the LAN. [def: this host only]')
+    parser.add_argument('-C', '--calib-pair', help='Fit y_field = gain * x_field + offset on the joined stream, '
+                        'may be repeated. Fields are named as in the joined points. [def: none]',
+                        metavar='x_field:y_field', type=parse_pair, action='append', default=[])
+    parser.add_argument('-H', '--calib-half-life', help='Forget samples with this half life, 0 = never. [def: %(default)s]',
+                        metavar='SEC', type=float, default=0)
+    parser.add_argument('--calib-state', help='Keep the calibration state in this file across restarts. [def: none]',
+                        metavar='file', type=Path, default=None)
+
+    args = parser.parse_args()
+
+    token = args.influxdb_token_file.open().readline().strip()
+    clt = influxdb_client.InfluxDBClient(url=args.influxdb_url, token=token)
+
+    max_age = args.max_age if args.max_age is not None else 2 * args.cadence
+    joiner = time_join.GridJoiner(args.cadence, max_age)
+
+    calib = None
+    if args.calib_pair:
+        lam = 0.5 ** (args.cadence / args.calib_half_life) if args.calib_half_life > 0 else 1.0
+        calib = online_calib.PairCalibration(args.calib_pair, lam)
+        if args.calib_state and args.calib_state.exists():
+            calib.load(args.calib_state)
+
+    event_loop = asyncio.new_event_loop()
+    event_loop.run_until_complete(mainloop(args, clt, joiner, calib))
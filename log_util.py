@@ -0,0 +1,50 @@
+#!/usr/bin/python
+#
+# Rate limiting of repeated warnings and errors, e.g. the same timeout on
+# every poll while the controller is disconnected. A message (same logger,
+# text and arguments) is let through once per interval; the next one that
+# passes tells how many were suppressed in between.
+#
+
+import logging
+import time
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=60.0, level=logging.WARNING, maxkeys=1024):
+        super().__init__()
+        self.interval = interval
+        self.level = level
+        self.maxkeys = maxkeys
+        self.seen = dict()  # key -> [t last passed, n suppressed]
+
+    def filter(self, record):
+        if record.levelno < self.level or self.interval <= 0:
+            return True
+
+        key = record.name, record.msg, repr(record.args)
+        now = time.monotonic()
+        entry = self.seen.get(key)
+        if entry is None:
+            if len(self.seen) >= self.maxkeys:
+                self.seen.clear()
+            self.seen[key] = [now, 0]
+            return True
+
+        if now - entry[0] < self.interval:
+            entry[1] += 1
+            return False
+
+        if entry[1]:
+            record.msg = '%s (%d times in %.0f s)' % (record.msg, entry[1] + 1,
+                                                      now - entry[0])
+        entry[0] = now
+        entry[1] = 0
+        return True
+
+
+def add_rate_limit(interval, logger=None):
+    '''Install a RateLimitFilter on all handlers of logger (def: root).'''
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        handler.addFilter(RateLimitFilter(interval))
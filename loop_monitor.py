@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+import asyncio
+import collections
+import logging
+import os.path
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+
+import stats_util
+
+log = logging.getLogger('loop_monitor')
+
+
+_LIB_DIRS = tuple(sysconfig.get_paths()[k]
+                  for k in ['stdlib', 'platstdlib', 'purelib', 'platlib'])
+
+
+def _fmt_frame(fs):
+    return '%s:%d(%s)' % (os.path.basename(fs.filename), fs.lineno, fs.name)
+
+
+def _describe(frame, task):
+    # innermost frame of the blocked thread, and if that is in a library
+    # (e.g. a socket call in influxdb_client) also our code that called it
+    stack = traceback.extract_stack(frame)
+    frames = [stack[-1]]
+    for fs in reversed(stack):
+        if not fs.filename.startswith(_LIB_DIRS):
+            if fs is not stack[-1]:
+                frames.append(fs)
+            break
+    where = ' < ... < '.join(_fmt_frame(fs) for fs in frames)
+    if task is not None:
+        return 'task %s: %s' % (task.get_name(), where)
+    return where
+
+
+#
+# A task sleeps for interval seconds and measures how late it wakes up,
+# this is the scheduling delay every other callback on the loop sees, too.
+# A watchdog thread looks at the loop thread's stack whenever the task
+# has not woken up for longer than threshold, so that slow wakeups can be
+# attributed to the code that was running at that time.
+#
+
+class LoopMonitor:
+    def __init__(self, interval=0.05, threshold=0.1, nsamples=1024,
+                 noffenders=10):
+        self.interval = interval
+        self.threshold = threshold
+        self.noffenders = noffenders
+
+        self.loop = None
+        self.thread_id = None
+        self.heartbeat = None
+        self.blame = None  # set by watchdog during a stall
+
+        self.lags = collections.deque(maxlen=nsamples)
+        self.n = 0
+        self.n_slow = 0
+        self.max_lag = 0.0
+        self.offenders = dict()  # description -> [count, total lag, max lag]
+
+    def start(self, loop):
+        '''Start monitoring loop, must be called from the loop's thread.'''
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        loop.create_task(self._sampler())
+        threading.Thread(target=self._watchdog, name='loop_monitor',
+                         daemon=True).start()
+
+    async def _sampler(self):
+        while True:
+            t0 = time.monotonic()
+            self.heartbeat = t0
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - t0 - self.interval)
+
+            self.n += 1
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            if lag < self.threshold:
+                self.blame = None
+                continue
+
+            self.n_slow += 1
+            blame = self.blame or 'unknown'
+            self.blame = None
+            log.warning('Event loop blocked for %.0f ms in %s',
+                        1e3 * lag, blame)
+
+            off = self.offenders.get(blame)
+            if off is None:
+                off = self.offenders[blame] = [0, 0.0, 0.0]
+            off[0] += 1
+            off[1] += lag
+            off[2] = max(off[2], lag)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            stalled = time.monotonic() - self.heartbeat - self.interval
+            if stalled < self.threshold or self.blame is not None:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            try:
+                task = asyncio.current_task(self.loop)
+            except RuntimeError:
+                task = None
+            self.blame = _describe(frame, task)
+
+    def as_dict(self):
+        s = sorted(self.lags)
+
+        worst = sorted(self.offenders.items(), key=lambda kv: -kv[1][1])
+        return {
+            'n': self.n,
+            'n_slow': self.n_slow,
+            'threshold': self.threshold,
+            'lag_p50': stats_util.percentile(s, 0.5),
+            'lag_p95': stats_util.percentile(s, 0.95),
+            'lag_p99': stats_util.percentile(s, 0.99),
+            'lag_max': self.max_lag,
+            'offenders': [
+                {'where': k, 'count': c, 'total_s': tot, 'max_s': mx}
+                for k, (c, tot, mx) in worst[:self.noffenders]
+            ],
+        }
@@ -9,6 +9,9 @@ import time
 import datetime
 import argparse
 
+import aggregate
+import publisher
+
 
 def read_sensor_list(fn):
     ret = list()
@@ -42,7 +45,7 @@ def read_sensor_list(fn):
 parser = argparse.ArgumentParser()
 parser.add_argument('sensors',
                     help='Sensor list.')
-parser.add_argument('-i', '--influxdb-url', help='Influxdb host. [def: %(default)s]',
+parser.add_argument('-i', '--influxdb-url', help='Influxdb host, - to only publish with -P. [def: %(default)s]',
                     metavar='host', type=str, default='http://127.0.0.1:8086/')
 parser.add_argument('-o', '--influxdb-org', help='Influxdb org. [def: %(default)s]',
                     metavar='org', type=str, default='vogel.cx')
@@ -58,16 +61,49 @@ parser.add_argument('-s', '--sleep', help='Sleep N seconds between polls [def: %
                     metavar='SEC', type=int, default=15)
 parser.add_argument('-d', '--debug', help='Be very verbose.',
                     action='store_true')
+parser.add_argument('-A', '--aggregate', help='Write min/max/mean/last per SEC seconds instead of every sample. [def: off]',
+                    metavar='SEC', type=int, default=0)
+parser.add_argument('--aggregate-bucket', help='Write aggregates here, raw samples to --influxdb-bucket. [def: aggregates replace raw samples]',
+                    metavar='db', type=str, default=None)
+parser.add_argument('-P', '--publish', metavar='GROUP:PORT', nargs='?',
+                    const=publisher.DEFAULT_ADDR, default=None,
+                    help='Publish readings on UDP multicast. [def: off, %(const)s if given without argument]')
+parser.add_argument('--publish-lan', action='store_true',
+                    help='Publish on the LAN segment, not only on this host. [def: off]')
 
 args = parser.parse_args()
+if args.influxdb_url == '-' and not args.publish:
+    parser.error('-i - without -P would neither write nor publish.')
 
 sensors = read_sensor_list(args.sensors)
 
-token = args.influxdb_token_file.open().readline().strip()
-influx_client = influxdb_client.InfluxDBClient(
-    url=args.influxdb_url, token=token)
+influx_client = None
+if args.influxdb_url and args.influxdb_url != '-':
+    token = args.influxdb_token_file.open().readline().strip()
+    influx_client = influxdb_client.InfluxDBClient(
+        url=args.influxdb_url, token=token)
+
+pub = None
+if args.publish:
+    pub = publisher.Publisher(args.publish, args.publish_lan)
+
+aggregator = None
+if args.aggregate > 0:
+    aggregator = aggregate.WindowAggregator(args.aggregate)
+
+# bucket -> points, with aggregation raw points are only kept if they
+# have their own bucket, nothing is kept if only publishing
+datapoints = dict()
+raw_bucket = args.influxdb_bucket
+agg_bucket = args.influxdb_bucket
+if aggregator:
+    agg_bucket = args.aggregate_bucket or args.influxdb_bucket
+    if not args.aggregate_bucket:
+        raw_bucket = None
+if not influx_client:
+    raw_bucket = None
+    aggregator = None
 
-datapoints = list()
 poll_ctr = 0
 
 while True:
@@ -117,27 +153,45 @@ while True:
             sys.stdout.flush()
 
     if influx_fields:
-        js_body = {
-            'measurement': args.influxdb_measurement,
-            'time': datetime.datetime.utcnow(),
-            'fields': influx_fields
-        }
-        datapoints.append(influxdb_client.Point.from_dict(
-            js_body, influxdb_client.WritePrecision.NS))
+        if raw_bucket:
+            js_body = {
+                'measurement': args.influxdb_measurement,
+                'time': now,
+                'fields': influx_fields
+            }
+            datapoints.setdefault(raw_bucket, list()).append(
+                influxdb_client.Point.from_dict(
+                    js_body, influxdb_client.WritePrecision.NS))
+        if aggregator:
+            agg = aggregator.add(now.timestamp(), influx_fields)
+            if agg:
+                t_window, agg_fields = agg
+                js_body = {
+                    'measurement': args.influxdb_measurement,
+                    'time': datetime.datetime.fromtimestamp(t_window, datetime.timezone.utc),
+                    'fields': agg_fields
+                }
+                datapoints.setdefault(agg_bucket, list()).append(
+                    influxdb_client.Point.from_dict(
+                        js_body, influxdb_client.WritePrecision.NS))
+        if pub:
+            pub.publish(args.influxdb_measurement, influx_fields)
     else:
         print(f'Not a single sensor had data???')
         sys.stdout.flush()
 
     if poll_ctr >= args.batchsize:
-        try:
-            wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
-            write_api = influx_client.write_api(wr_opts)
-            ret = write_api.write(args.influxdb_bucket,
-                                  args.influxdb_org, datapoints)
-            datapoints.clear()
-        except Exception as e:
-            print(f'Exception occured writing points to influxdb.')
-            print(e)
+        for bucket, points in datapoints.items():
+            if not points:
+                continue
+            try:
+                wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
+                write_api = influx_client.write_api(wr_opts)
+                ret = write_api.write(bucket, args.influxdb_org, points)
+                points.clear()
+            except Exception as e:
+                print(f'Exception occured writing points to influxdb.')
+                print(e)
         poll_ctr = 0
 
     time.sleep(args.sleep)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+#
+# Linear regression y = gain * x + offset, updated one sample at a time in
+# constant memory (weighted Welford update of means and co-moments). With
+# a forgetting factor lam < 1, a sample n updates old has weight lam**n, so
+# the fit follows slow drifts of the sensors.
+#
+
+import json
+import logging
+import math
+
+log = logging.getLogger('online_calib')
+
+
+class RunningRegression:
+    STATE = ['w', 'mx', 'my', 'cxx', 'cxy', 'cyy', 'n']
+
+    def __init__(self, lam=1.0):
+        self.lam = lam
+        self.w = 0.0  # sum of weights
+        self.mx = 0.0
+        self.my = 0.0
+        self.cxx = 0.0
+        self.cxy = 0.0
+        self.cyy = 0.0
+        self.n = 0
+
+    def update(self, x, y):
+        self.n += 1
+        self.w = self.lam * self.w + 1.0
+        dx = x - self.mx
+        dy = y - self.my
+        self.mx += dx / self.w
+        self.my += dy / self.w
+        self.cxx = self.lam * self.cxx + dx * (x - self.mx)
+        self.cxy = self.lam * self.cxy + dx * (y - self.my)
+        self.cyy = self.lam * self.cyy + dy * (y - self.my)
+
+    def fit(self):
+        '''Returns (gain, offset, rms of residual, correlation) or None.'''
+        if self.n < 2 or self.cxx <= 0:
+            return None
+        gain = self.cxy / self.cxx
+        offset = self.my - gain * self.mx
+        rms = math.sqrt(max(0.0, self.cyy - gain * self.cxy) / self.w)
+        corr = self.cxy / math.sqrt(self.cxx * self.cyy) if self.cyy > 0 else 0.0
+        return gain, offset, rms, corr
+
+    def get_state(self):
+        return {k: getattr(self, k) for k in self.STATE}
+
+    def set_state(self, state):
+        for k in self.STATE:
+            setattr(self, k, state[k])
+
+
+class PairCalibration:
+    def __init__(self, pairs, lam=1.0):
+        # pairs: list of (x field, y field)
+        self.pairs = {'%s:%s' % p: (p, RunningRegression(lam)) for p in pairs}
+
+    def update(self, fields):
+        for (x_name, y_name), reg in self.pairs.values():
+            x = fields.get(x_name)
+            y = fields.get(y_name)
+            if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+                reg.update(x, y)
+
+    def as_dict(self):
+        ret = dict()
+        for key, (pair, reg) in self.pairs.items():
+            fit = reg.fit()
+            ret[key] = {'n': reg.n}
+            if fit is not None:
+                gain, offset, rms, corr = fit
+                ret[key].update(gain=gain, offset=offset, rms=rms, corr=corr)
+        return ret
+
+    def fields(self):
+        '''Current fit of every pair as fields for a database point.'''
+        ret = dict()
+        for (x_name, y_name), reg in self.pairs.values():
+            fit = reg.fit()
+            if fit is None:
+                continue
+            prefix = 'calib_%s_%s_' % (x_name, y_name)
+            ret[prefix + 'gain'], ret[prefix + 'offset'], ret[prefix + 'rms'], _ = fit
+        return ret
+
+    def save(self, fn):
+        state = {key: reg.get_state() for key, (pair, reg) in self.pairs.items()}
+        with open(fn, 'w') as f:
+            json.dump(state, f)
+
+    def load(self, fn):
+        with open(fn) as f:
+            state = json.load(f)
+        for key, (pair, reg) in self.pairs.items():
+            if key in state:
+                reg.set_state(state[key])
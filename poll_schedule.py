@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# Poll intervals per variable that follow the state of the boiler. Rules
+# are declared in the variable list, see viessmann_variables.txt:
+#
+#   @ p_burner > 0   5  t_boiler t_exhaust
+#
+# While p_burner > 0, t_boiler and t_exhaust are polled every 5 seconds,
+# otherwise every --sleep seconds. If several rules match a variable the
+# last one in the file wins. Rules are evaluated whenever a value they
+# depend on is decoded, so a new interval applies to the very next cycle.
+#
+
+import collections
+import logging
+import operator
+
+log = logging.getLogger('poll_schedule')
+
+PollRule = collections.namedtuple('PollRule',
+                                  ['var', 'op', 'value', 'interval', 'targets'])
+
+OPERATORS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+BUS_CAPACITY = 0.7  # fraction of bus time the schedule may use
+DEFAULT_COST = 0.1  # [s] assumed bus time of a read without measurements
+BUNDLE_SLACK = 1.0  # [s] poll variables due within this time together
+
+
+def load_poll_rules(fn):
+    ret = list()
+
+    with open(fn, 'rt') as f:
+        for lno, line in enumerate(f, 1):
+            ix = line.find('#')
+            if ix != -1:
+                line = line[:ix]
+            line = line.strip()
+
+            if not line.startswith('@'):
+                continue
+
+            arr = line[1:].split()
+            if len(arr) < 5:
+                raise RuntimeError(
+                    '%s:%d need: @ variable op value interval targets...' % (fn, lno))
+            if arr[1] not in OPERATORS:
+                raise RuntimeError('%s:%d unknown operator %s' % (fn, lno, arr[1]))
+
+            ret.append(PollRule(arr[0], arr[1], float(arr[2]), float(arr[3]),
+                                arr[4:]))
+
+    return ret
+
+
+class PollScheduler:
+    def __init__(self, varlist, rules, default_interval, timing=None,
+                 capacity=BUS_CAPACITY):
+        self.varlist = varlist
+        self.rules = rules
+        self.default_interval = default_interval
+        self.timing = timing
+        self.capacity = capacity
+
+        names = set(item.name for item in varlist)
+        for rule in rules:
+            for name in [rule.var] + rule.targets:
+                if name not in names:
+                    raise RuntimeError('Poll rule uses unknown variable %s.' % name)
+        self.rule_vars = set(rule.var for rule in rules)
+
+        self.values = dict()
+        self.last_poll = dict()
+        self.interval = {item.name: default_interval for item in varlist}
+        self.scale = 1.0
+        self._apply_rules()
+
+    def _cost(self, item):
+        if self.timing is not None:
+            rtts = self.timing.rtt.get(item.addr)
+            if rtts:
+                return sum(rtts) / len(rtts)
+        return DEFAULT_COST
+
+    def _apply_rules(self):
+        interval = {item.name: self.default_interval for item in self.varlist}
+        for rule in self.rules:
+            v = self.values.get(rule.var)
+            if v is None or not OPERATORS[rule.op](v, rule.value):
+                continue
+            for name in rule.targets:
+                interval[name] = rule.interval
+
+        for name, t in interval.items():
+            if t != self.interval[name]:
+                log.info('Poll %s every %g s (was %g s).',
+                         name, t, self.interval[name])
+        self.interval = interval
+
+        # stretch all intervals if the rules ask for more than the bus can
+        # do, interval 0 (poll back to back) takes what is left anyway
+        load = sum(self._cost(item) / interval[item.name]
+                   for item in self.varlist if interval[item.name] > 0)
+        scale = max(1.0, load / self.capacity)
+        if abs(scale - self.scale) > 0.1 * self.scale:
+            log.warning('Schedule needs %.0f%% of bus time, stretching '
+                        'intervals by %.2f.', 100 * load, scale)
+        self.scale = scale
+
+    def update(self, name, v):
+        old = self.values.get(name)
+        self.values[name] = v
+        if name in self.rule_vars and v != old:
+            self._apply_rules()
+
+    def _next(self, item):
+        last = self.last_poll.get(item.name)
+        if last is None:
+            return float('-inf')
+        return last + self.scale * self.interval[item.name]
+
+    def next_due(self):
+        return min(self._next(item) for item in self.varlist)
+
+    def due(self, now):
+        '''Variables to poll now, in variable list order.'''
+        return [item for item in self.varlist
+                if self._next(item) <= now + BUNDLE_SLACK]
+
+    def polled(self, name, now):
+        self.last_poll[name] = now
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+#
+# Answers from the controller, kept per (addr, length), together with a
+# popularity score of what web clients ask for. The score decays
+# exponentially, so addresses that are no longer queried drop out of the
+# hot set. The daemon refreshes the hot set in idle bus time at
+# background priority, see PollMainLoop.prefetch().
+#
+
+import logging
+
+log = logging.getLogger('prefetch')
+
+
+class HotCache:
+    def __init__(self, nhot=8, half_life=600.0, min_score=2.0):
+        self.nhot = nhot
+        self.half_life = half_life
+        self.min_score = min_score
+
+        self.scores = dict()  # (addr, length) -> [score, t]
+        self.cache = dict()  # (addr, length) -> (t, payload)
+        self.n_hit = 0
+        self.n_miss = 0
+        self.n_prefetch = 0
+
+    def _score(self, key, now):
+        s = self.scores.get(key)
+        if s is None:
+            return 0.0
+        return s[0] * 2 ** (-(now - s[1]) / self.half_life)
+
+    def record(self, key, now):
+        '''A client asked for key.'''
+        self.scores[key] = [self._score(key, now) + 1.0, now]
+
+    def lookup(self, key, now, max_age):
+        entry = self.cache.get(key)
+        if entry is not None and now - entry[0] <= max_age:
+            self.n_hit += 1
+            return entry[1]
+        self.n_miss += 1
+        return None
+
+    def store(self, key, now, payload):
+        self.cache[key] = (now, payload)
+
+    def hot(self, now):
+        scored = [(self._score(key, now), key) for key in self.scores]
+        # forget what has decayed to nothing, keeps the dicts small
+        for score, key in scored:
+            if score < 0.01:
+                del self.scores[key]
+                self.cache.pop(key, None)
+        scored.sort(reverse=True)
+        return [key for score, key in scored[:self.nhot]
+                if score >= self.min_score]
+
+    def stale(self, now, refresh_age):
+        '''Hot keys older than refresh_age, oldest first.'''
+        ret = list()
+        for key in self.hot(now):
+            entry = self.cache.get(key)
+            t = entry[0] if entry else float('-inf')
+            if now - t >= refresh_age:
+                ret.append((t, key))
+        return [key for t, key in sorted(ret)]
+
+    def as_dict(self, now):
+        return {
+            'hits': self.n_hit,
+            'misses': self.n_miss,
+            'prefetched': self.n_prefetch,
+            'hot': ['%04x/%d' % key for key in self.hot(now)],
+        }
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+#
+# Publish decoded samples once per poll as UDP multicast datagrams on the
+# local host, any number of consumers can subscribe without extra cost for
+# the publisher. With multicast TTL 0 the datagrams never leave the host
+# (only looped back to local subscribers), and subscribers drop datagrams
+# from other hosts. Publishing to the LAN segment (TTL 1) and accepting
+# samples from it has to be asked for with lan=True.
+#
+# Each datagram is a CBOR (RFC 8949) encoded map
+#
+#   {'src': 'optolink', 't': <ns since epoch>, 'v': {name: value, ...}}
+#
+# with an optional 'tags' map. Run this module to dump what is published:
+#
+#   python publisher.py [GROUP:PORT]
+#
+
+import logging
+import socket
+import struct
+import time
+
+log = logging.getLogger('publisher')
+
+DEFAULT_GROUP = '239.255.42.47'
+DEFAULT_PORT = 22248
+DEFAULT_ADDR = '%s:%d' % (DEFAULT_GROUP, DEFAULT_PORT)
+
+
+###
+# minimal CBOR, just what we need for samples
+###
+def _cbor_head(major, n):
+    if n < 24:
+        return bytes([major << 5 | n])
+    if n < 0x100:
+        return struct.pack('>BB', major << 5 | 24, n)
+    if n < 0x10000:
+        return struct.pack('>BH', major << 5 | 25, n)
+    if n < 0x100000000:
+        return struct.pack('>BL', major << 5 | 26, n)
+    return struct.pack('>BQ', major << 5 | 27, n)
+
+
+def cbor_encode(obj):
+    if obj is False:
+        return b'\xf4'
+    if obj is True:
+        return b'\xf5'
+    if obj is None:
+        return b'\xf6'
+    if isinstance(obj, int):
+        if obj >= 0:
+            return _cbor_head(0, obj)
+        return _cbor_head(1, -1 - obj)
+    if isinstance(obj, float):
+        return b'\xfb' + struct.pack('>d', obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return _cbor_head(2, len(obj)) + bytes(obj)
+    if isinstance(obj, str):
+        b = obj.encode('utf-8')
+        return _cbor_head(3, len(b)) + b
+    if isinstance(obj, (list, tuple)):
+        return _cbor_head(4, len(obj)) + b''.join(cbor_encode(v) for v in obj)
+    if isinstance(obj, dict):
+        return _cbor_head(5, len(obj)) + b''.join(
+            cbor_encode(k) + cbor_encode(v) for k, v in obj.items())
+    raise TypeError('Cannot encode %s as CBOR.' % type(obj).__name__)
+
+
+def _cbor_decode(data, pos):
+    ib = data[pos]
+    major, info = ib >> 5, ib & 0x1f
+    pos += 1
+
+    if major == 7:
+        if info == 20:
+            return False, pos
+        if info == 21:
+            return True, pos
+        if info == 22:
+            return None, pos
+        if info == 25:
+            return struct.unpack_from('>e', data, pos)[0], pos + 2
+        if info == 26:
+            return struct.unpack_from('>f', data, pos)[0], pos + 4
+        if info == 27:
+            return struct.unpack_from('>d', data, pos)[0], pos + 8
+        raise ValueError('Unsupported CBOR simple value %d.' % info)
+
+    if info < 24:
+        n = info
+    elif info <= 27:
+        fmt = {24: '>B', 25: '>H', 26: '>L', 27: '>Q'}[info]
+        n, = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+    else:
+        raise ValueError('Unsupported CBOR length encoding %d.' % info)
+
+    if major == 0:
+        return n, pos
+    if major == 1:
+        return -1 - n, pos
+    if major == 2:
+        return bytes(data[pos:pos + n]), pos + n
+    if major == 3:
+        return bytes(data[pos:pos + n]).decode('utf-8'), pos + n
+    if major == 4:
+        ret = list()
+        for _ in range(n):
+            v, pos = _cbor_decode(data, pos)
+            ret.append(v)
+        return ret, pos
+    if major == 5:
+        ret = dict()
+        for _ in range(n):
+            k, pos = _cbor_decode(data, pos)
+            v, pos = _cbor_decode(data, pos)
+            ret[k] = v
+        return ret, pos
+    raise ValueError('Unsupported CBOR major type %d.' % major)
+
+
+def cbor_decode(data):
+    v, pos = _cbor_decode(data, 0)
+    return v
+
+
+def parse_addr(s):
+    group, _, port = s.rpartition(':')
+    return group or DEFAULT_GROUP, int(port)
+
+
+def is_local(ip):
+    '''True if ip is an address of this host, i.e. one can bind to it.'''
+    ret = _local_addrs.get(ip)
+    if ret is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((ip, 0))
+            ret = True
+        except OSError:
+            ret = False
+        finally:
+            sock.close()
+        if len(_local_addrs) >= 256:
+            _local_addrs.clear()
+        _local_addrs[ip] = ret
+    return ret
+
+
+_local_addrs = dict()  # ip -> bool, cache of is_local()
+
+
+class Publisher:
+    def __init__(self, addr=DEFAULT_ADDR, lan=False):
+        self.addr = parse_addr(addr)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                             1 if lan else 0)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.setblocking(False)
+        self.n_sent = 0
+        self.n_err = 0
+
+    def publish(self, source, fields, t=None, tags=None):
+        msg = {
+            'src': source,
+            't': time.time_ns() if t is None else t,
+            'v': fields,
+        }
+        if tags:
+            msg['tags'] = tags
+        try:
+            self.sock.sendto(cbor_encode(msg), self.addr)
+            self.n_sent += 1
+        except (OSError, TypeError) as e:
+            # nobody must ever be blocked by a missing consumer
+            self.n_err += 1
+            log.debug('Cannot publish sample: %s', e)
+
+
+def subscribe(addr=DEFAULT_ADDR):
+    '''Return a UDP socket that receives the published samples. It also
+    gets what other hosts send to the group, check the sender with
+    is_local() unless samples from the LAN are wanted.'''
+    group, port = parse_addr(addr)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    mreq = socket.inet_aton(group) + socket.inet_aton('0.0.0.0')
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
+
+
+if __name__ == '__main__':
+    import sys
+
+    sock = subscribe(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_ADDR)
+    while True:
+        data, sender = sock.recvfrom(65536)
+        try:
+            print(sender[0], cbor_decode(data))
+        except Exception as e:
+            print(sender[0], 'undecodable datagram:', e)
+        sys.stdout.flush()
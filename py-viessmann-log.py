@@ -1,43 +1,195 @@
 #!/usr/bin/python
 from pathlib import Path
 import asyncio
+import atexit
+import collections
 import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
 import time
 
 import serial_asyncio
 from aiohttp import web
 import influxdb_client
 
+import aggregate
+import bus_arbiter
+import derived_metrics
+import log_util
+import loop_monitor
+import poll_schedule
+import prefetch
+import publisher
+import stats_util
+import tsstore
 import viessmann_decode
 import vitotronic
+import web_frontend
 import datetime
 
 
 log = logging.getLogger('py-viessmann-log')
 
 
-async def poll_msg(vito_proto, addr, length):
+POLL_BUDGET = 0.5  # [s] max. time spent on one variable, including retries
+POLL_RETRIES = 1  # immediate retries within POLL_BUDGET
+WEB_MAX_WAIT = 2.0  # [s] max. time a web query waits for the bus
+WEB_MAX_BATCH = 64  # max. number of items in one batch query
+WEB_BATCH_CHUNK = 8  # bus reads of a batch query per slot, the poll may run between
+PREFETCH_TICK = 0.5  # [s] how often to look for stale hot addresses
+PREFETCH_MARGIN = 2.0  # [s] no prefetch if the regular poll is closer
+SNAPSHOT_INTERVAL = 0.5  # [s] how often web workers get fresh values
+NOT_READY_WAIT = 0.2  # [s] poll retry interval while the protocol is not ready
+
+
+class AddrTiming:
+    '''Round-trip times per address, used to derive the timeout in poll_msg.
+
+    The timeout is a high percentile of the recently seen round-trip times
+    times a safety factor, clamped to [t_min, t_max]. After a timeout the
+    value for that address is doubled until the next successful read, so
+    an address that became slower is not locked out forever.
+
+    extra is the additional round-trip time of a network link to the
+    adapter, added to the margin and both limits.
+    '''
+
+    def __init__(self, nsamples=32, quantile=0.95, factor=1.5, margin=0.03,
+                 t_min=0.1, t_max=POLL_BUDGET, extra=0.0):
+        self.nsamples = nsamples
+        self.quantile = quantile
+        self.factor = factor
+        self.margin = margin + extra
+        self.t_min = t_min + extra
+        self.t_max = t_max + extra
+
+        self.rtt = dict()  # addr -> deque of round trip times [s]
+        self.backoff = dict()  # addr -> multiplier after timeouts
+        self.stats = dict()  # addr -> dict of counters
+
+    def _percentile(self, addr, q):
+        return stats_util.percentile(sorted(self.rtt.get(addr, ())), q)
+
+    def timeout(self, addr):
+        q = self._percentile(addr, self.quantile)
+        if q is None:
+            return self.t_max
+        t = (self.factor * q + self.margin) * self.backoff.get(addr, 1)
+        return min(self.t_max, max(self.t_min, t))
+
+    def add_rtt(self, addr, rtt):
+        if addr not in self.rtt:
+            self.rtt[addr] = collections.deque(maxlen=self.nsamples)
+        self.rtt[addr].append(rtt)
+        self.backoff.pop(addr, None)
+
+    def add_timeout(self, addr):
+        self.backoff[addr] = 2 * self.backoff.get(addr, 1)
+
+    def account(self, addr, ok, attempts, waited):
+        st = self.stats.get(addr)
+        if st is None:
+            st = self.stats[addr] = dict(ok=0, fail=0, retries=0,
+                                         wait_s=0.0, wait_fail_s=0.0)
+        st['ok' if ok else 'fail'] += 1
+        st['retries'] += attempts - 1
+        st['wait_s'] += waited
+        if not ok:
+            st['wait_fail_s'] += waited
+
+    def as_dict(self):
+        ret = dict()
+        for addr, st in sorted(self.stats.items()):
+            d = dict(st)
+            d['rtt_p50'] = self._percentile(addr, 0.5)
+            d['rtt_p95'] = self._percentile(addr, 0.95)
+            d['timeout'] = self.timeout(addr)
+            ret['%04x' % addr] = d
+        return ret
+
+
+async def _poll_once(vito_proto, addr, length, timeout):
     vito_proto.clear_rx_queue()
     if vito_proto.request_read(addr, length):
         return None
-    for ticks in range(10):
-        await asyncio.sleep(0.05)
 
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
         if vito_proto.rx_nak_ctr:
             return 'NAK received.'
         if vito_proto.rx_to_ctr:
             return 'Timeout on RX (signalled by protocol).'
         if vito_proto.rx_err_ctr:
             return 'Error: Protocol error on RX.'
-        if vito_proto.rx_queue:
+        while vito_proto.rx_queue:
             msgtype, method, rx_addr, payload = vito_proto.rx_queue.pop(0)
-            if rx_addr == addr:
-                if len(payload) != length:
-                    return 'Error: wrong length, expected %d, got %d' % (length, len(payload))
-                return msgtype, method, rx_addr, payload
-            else:
-                return 'Error: wrong address, expected %d, got %d' % (addr, rx_addr)
-    return 'Error: Timeout waiting on answer.'
+            if rx_addr != addr:
+                # late answer to a request that already timed out
+                log.debug('Discarding answer for %04x, waiting for %04x.',
+                          rx_addr, addr)
+                continue
+            if len(payload) != length:
+                return 'Error: wrong length, expected %d, got %d' % (length, len(payload))
+            return msgtype, method, rx_addr, payload
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return 'Error: Timeout waiting on answer.'
+        vito_proto.rx_event.clear()
+        try:
+            await asyncio.wait_for(vito_proto.rx_event.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def poll_msg(vito_proto, addr, length, timing=None):
+    '''Read length bytes at addr, must be called with the bus held.
+
+    Returns None if the protocol is not ready, an error string or the
+    tuple (msgtype, method, addr, payload). On errors the read is retried
+    up to POLL_RETRIES times, but only as long as the total time stays
+    within POLL_BUDGET (plus the link latency, see AddrTiming), so a retry
+    never makes the poll cycle longer than a single fixed-timeout read did.
+    '''
+    loop = asyncio.get_running_loop()
+    t_start = loop.time()
+    deadline = t_start + (timing.t_max if timing else POLL_BUDGET)
+
+    ret = None
+    attempts = 0
+    for attempts in range(1, POLL_RETRIES + 2):
+        timeout = timing.timeout(addr) if timing else POLL_BUDGET
+        remaining = deadline - loop.time()
+        if attempts > 1 and timeout > remaining:
+            attempts -= 1
+            break
+
+        t_req = loop.time()
+        this = await _poll_once(vito_proto, addr, length,
+                                min(timeout, remaining))
+        if this is None:  # protocol not synced, nothing sent
+            attempts -= 1
+            break
+
+        ret = this
+        if type(ret) == tuple:
+            if timing:
+                timing.add_rtt(addr, loop.time() - t_req)
+            break
+
+        if timing and ret == 'Error: Timeout waiting on answer.':
+            timing.add_timeout(addr)
+        log.debug('[%04x/%d] attempt %d failed: %s',
+                  addr, length, attempts, ret)
+
+    if timing and attempts:
+        timing.account(addr, type(ret) == tuple, attempts,
+                       loop.time() - t_start)
+    return ret
 
 
 class PollMainLoop:
@@ -47,8 +199,44 @@ class PollMainLoop:
         self.varlist = varlist
         self.args = args
         self.recent_data = dict()
-
-        self.vito_lock = asyncio.Lock()
+        self.timing = AddrTiming(extra=args.link_latency or 0.0)
+
+        self.bus = bus_arbiter.BusArbiter()
+        self.loop_monitor = None
+        self.snapshot = None  # shared with the web workers
+        self.cycle_times = collections.deque(maxlen=256)
+
+        ###
+        # optional stages, configured on the command line
+        ###
+        self.scheduler = None
+        poll_rules = poll_schedule.load_poll_rules(args.variablelist)
+        if poll_rules:
+            self.scheduler = poll_schedule.PollScheduler(
+                varlist, poll_rules, args.sleep, self.timing)
+
+        self.derived = None
+        if args.derived:
+            self.derived = derived_metrics.DerivedMetrics(
+                derived_metrics.load_derived_metrics(args.derived))
+
+        self.publisher = None
+        if args.publish:
+            self.publisher = publisher.Publisher(args.publish,
+                                                 args.publish_lan)
+
+        self.hot_cache = None
+        self.next_cycle = None  # monotonic time the regular poll starts again
+        if args.prefetch > 0:
+            self.hot_cache = prefetch.HotCache(args.prefetch)
+
+        self.aggregator = None
+        if args.aggregate > 0:
+            self.aggregator = aggregate.WindowAggregator(args.aggregate)
+
+        self.store = None
+        if args.store:
+            self.store = tsstore.TimeSeriesStore(args.store)
 
     async def handle_web_query(self, request):
         try:
@@ -63,8 +251,17 @@ class PollMainLoop:
                       request.match_info, exc_info=True)
             return web.Response(status=500, text='Exception while parsing URL.')
 
-        async with self.vito_lock:
-            ret = await poll_msg(self.vito_proto, addr, length)
+        payload = self._cache_lookup(addr, length)
+        if payload is not None:
+            ret = None, None, addr, payload
+        else:
+            try:
+                async with self.bus.slot(bus_arbiter.INTERACTIVE, WEB_MAX_WAIT):
+                    ret = await poll_msg(self.vito_proto, addr, length,
+                                         self.timing)
+            except asyncio.TimeoutError:
+                return web.Response(status=503, text='Bus busy, try again.')
+            self._cache_store(addr, length, ret)
 
         if ret is None:
             return web.Response(status=500, text='Serial port not ready.')
@@ -83,95 +280,376 @@ class PollMainLoop:
 
         return web.Response(status=200, text=text)
 
+    def _cache_lookup(self, addr, length):
+        if not self.hot_cache:
+            return None
+        now = time.monotonic()
+        self.hot_cache.record((addr, length), now)
+        return self.hot_cache.lookup((addr, length), now,
+                                     self.args.prefetch_age)
+
+    def _cache_store(self, addr, length, ret):
+        if self.hot_cache and type(ret) == tuple:
+            self.hot_cache.store((addr, length), time.monotonic(), ret[3])
+
+    def _idle(self, margin):
+        '''True if the regular poll sleeps for at least margin seconds.'''
+        return (self.next_cycle is not None and
+                self.next_cycle - time.monotonic() >= margin)
+
+    async def prefetch(self):
+        ###
+        # keep answers for addresses web clients often ask for fresh,
+        # using the bus only while the regular poll sleeps
+        ###
+        refresh_age = 0.5 * self.args.prefetch_age
+        while True:
+            await asyncio.sleep(PREFETCH_TICK)
+            now = time.monotonic()
+            if not self._idle(PREFETCH_MARGIN):
+                continue
+
+            for addr, length in self.hot_cache.stale(now, refresh_age):
+                if not self._idle(PREFETCH_MARGIN):
+                    break
+                # wait for the bus no longer than the idle gap lasts
+                wait = self.next_cycle - time.monotonic() - PREFETCH_MARGIN
+                try:
+                    async with self.bus.slot(bus_arbiter.BACKGROUND, wait):
+                        # the regular poll may have started while waiting
+                        if not self._idle(PREFETCH_MARGIN):
+                            break
+                        ret = await poll_msg(self.vito_proto, addr, length,
+                                             self.timing)
+                except asyncio.TimeoutError:
+                    break
+                if type(ret) == tuple:
+                    self.hot_cache.n_prefetch += 1
+                self._cache_store(addr, length, ret)
+
+    async def _read_batch(self, reads, plan):
+        # reads: list of (addr, length), plan: from plan_reads(reads)
+        # returns list of payloads or error strings
+        ret = [None] * len(reads)
+        for start, length, ixs in plan:
+            rx = await poll_msg(self.vito_proto, start, length, self.timing)
+            if rx is None:
+                break  # controller not ready, no point in trying the rest
+
+            if type(rx) == tuple:
+                payload = rx[3]
+                for ix in ixs:
+                    addr, item_len = reads[ix]
+                    ret[ix] = payload[addr - start:addr - start + item_len]
+            elif len(ixs) == 1:
+                ret[ixs[0]] = rx
+            else:
+                # controller refused the merged read, try one by one
+                for ix in ixs:
+                    addr, item_len = reads[ix]
+                    rx = await poll_msg(self.vito_proto, addr, item_len,
+                                        self.timing)
+                    ret[ix] = rx[3] if type(rx) == tuple else rx
+
+        return [r if r is not None else 'Serial port not ready.' for r in ret]
+
+    async def handle_web_batch_query(self, request):
+        ###
+        # body is a json list of [addr, tag_or_len], addr as hex string
+        ###
+        try:
+            req = await request.json()
+            if type(req) != list or len(req) > WEB_MAX_BATCH:
+                raise RuntimeError('need a list of at most %d items' %
+                                   WEB_MAX_BATCH)
+        except Exception as e:
+            log.error('Exception while parsing batch query.', exc_info=True)
+            return web.Response(status=400, text='Cannot parse request: %s' % e)
+
+        results = list()
+        decoders = list()
+        reads = list()
+        for it in req:
+            try:
+                addr_str, tag_or_len = it
+                addr = int(addr_str, 16)
+                if addr < 0 or addr > 0xffff:
+                    raise RuntimeError('address not in range 0000 .. ffff')
+                length, decode_fct, fmt = viessmann_decode.gen_decoder(
+                    str(tag_or_len))
+            except Exception as e:
+                results.append({'query': it, 'error': 'Cannot parse: %s' % e})
+                continue
+            results.append({'addr': '%04x' % addr, 'type': tag_or_len})
+            decoders.append((len(results) - 1, decode_fct, fmt))
+            reads.append((addr, length))
+
+        payloads = [self._cache_lookup(addr, length) for addr, length in reads]
+        missing = [ix for ix, p in enumerate(payloads) if p is None]
+
+        if missing:
+            to_read = [reads[ix] for ix in missing]
+            plan = viessmann_decode.plan_reads(to_read)
+            rx = ['Bus busy, try again.'] * len(to_read)
+            # the first slot pays for all reads, the others hold the bus
+            # for further chunks without a charge
+            cost = len(plan)
+            for k in range(0, len(plan), WEB_BATCH_CHUNK):
+                chunk = plan[k:k + WEB_BATCH_CHUNK]
+                try:
+                    async with self.bus.slot(bus_arbiter.INTERACTIVE,
+                                             WEB_MAX_WAIT, cost):
+                        chunk_rx = await self._read_batch(to_read, chunk)
+                except asyncio.TimeoutError:
+                    if k == 0:
+                        return web.Response(status=503, text='Bus busy, try again.')
+                    break
+                cost = 0
+                for start, length, ixs in chunk:
+                    for ix in ixs:
+                        rx[ix] = chunk_rx[ix]
+
+            for ix, payload in zip(missing, rx):
+                payloads[ix] = payload
+                if type(payload) != str:
+                    self._cache_store(*reads[ix], (None, None, None, payload))
+
+        for (ix, decode_fct, fmt), payload in zip(decoders, payloads):
+            if type(payload) == str:
+                results[ix]['error'] = payload
+                continue
+            try:
+                v = decode_fct(payload)
+                results[ix]['value'] = v
+                results[ix]['text'] = fmt % v
+            except Exception as e:
+                results[ix]['error'] = 'Cannot decode %s: %s' % (
+                    vitotronic.hexlify(payload), e)
+
+        return web.json_response(results)
+
     async def handle_sensor_query(self, request):
         return web.json_response(self.recent_data)
 
-    async def perform_regular_query(self):
+    async def handle_stats_query(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        ct = sorted(self.cycle_times)
+        stats = {
+            'cycle': {
+                'n': len(ct),
+                'p50': stats_util.percentile(ct, 0.5),
+                'p95': stats_util.percentile(ct, 0.95),
+                'max': ct[-1] if ct else None,
+            },
+            'poll': self.timing.as_dict(),
+            'bus': self.bus.as_dict(),
+            'link': self.vito_proto.link_stats(),
+        }
+        if self.loop_monitor:
+            stats['loop'] = self.loop_monitor.as_dict()
+        if self.hot_cache:
+            stats['prefetch'] = self.hot_cache.as_dict(time.monotonic())
+        return stats
+
+    async def write_snapshots(self):
+        while True:
+            self.snapshot.write({
+                't': time.time(),
+                'sensor': self.recent_data,
+                'stats': self.stats(),
+            })
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+    async def handle_store_query(self, request):
+        return await web_frontend.store_response(self.store, request)
+
+    async def perform_regular_query(self, items):
         influx_fields = dict()
 
-        for item in self.varlist:
-            async with self.vito_lock:
-                ret = await poll_msg(self.vito_proto, item.addr, item.length)
+        # with --log-summary, one line per cycle instead of per variable
+        item_lvl = logging.DEBUG if self.args.log_summary else logging.INFO
+        log_items = log.isEnabledFor(item_lvl)
+        t_start = time.monotonic()
+        n_ok = 0
+        n_err = 0
+        changed = list()
+        not_ready = False
+
+        for item in items:
+            if self.scheduler:
+                # stamped with the cycle start, not the read time, so
+                # variables polled together stay due together
+                self.scheduler.polled(item.name, t_start)
+            async with self.bus.slot(bus_arbiter.SCHEDULED):
+                ret = await poll_msg(self.vito_proto, item.addr, item.length,
+                                     self.timing)
             if ret is None:
-                log.info('Controller is not ready. Skipping.')
+                log.log(item_lvl, 'Controller is not ready. Skipping.')
+                not_ready = True
                 break  # not in correct rx state, still unsynced, don't even try
 
             if type(ret) != tuple:
                 log.error('%s [%04x/%d] error %s while talking to controller',
                           item.name, item.addr, item.length, str(ret))
+                n_err += 1
                 continue
 
             msgtype, method, rx_addr, payload = ret
+            self._cache_store(item.addr, item.length, ret)
 
             try:
                 v = item.decoder(payload)
             except Exception as e:
                 log.error('%-12s ERR, raw=%s, exception=%s',
                           item.name, vitotronic.hexlify(payload), e)
+                n_err += 1
+                continue
 
-            log.info('%-12s ' + item.format, item.name, v)
+            if log_items:
+                log.log(item_lvl, '%-12s ' + item.format, item.name, v)
+
+            n_ok += 1
+            prev = self.recent_data.get(item.name)
+            if prev is None or prev[0] != v:
+                changed.append((item.name, v))
 
             now = datetime.datetime.now().astimezone()
             self.recent_data[item.name] = [v, now.isoformat()]
 
+            if self.derived:
+                self.derived.update(item.name, now.timestamp(), v)
+            if self.scheduler:
+                self.scheduler.update(item.name, v)
+
             if item.to_influxdb:
                 influx_fields[item.name] = v
+
+        if self.derived and influx_fields:
+            now = datetime.datetime.now().astimezone()
+            for name, v in self.derived.values().items():
+                self.recent_data[name] = [v, now.isoformat()]
+                influx_fields[name] = v
+
+        if self.args.log_summary and log.isEnabledFor(logging.INFO):
+            log.info('Poll: %d ok, %d err%s, %.2f s, changed: %s',
+                     n_ok, n_err, ', not ready' if not_ready else '',
+                     time.monotonic() - t_start,
+                     ' '.join('%s=%s' % c for c in changed) or '-')
+
         return influx_fields
 
+    def make_point(self, t, fields):
+        js_body = {
+            'measurement': self.args.influxdb_measurement,
+            'time': t,
+            'fields': fields
+        }
+        return influxdb_client.Point.from_dict(
+            js_body, influxdb_client.WritePrecision.NS)
+
     async def tick(self):
         poll_ctr = 0
-        datapoint_storage = list()
+        datapoint_storage = collections.defaultdict(list)  # bucket -> points
+
+        # with aggregation, raw points are only kept if they have their own bucket
+        raw_bucket = self.args.influxdb_bucket
+        agg_bucket = self.args.influxdb_bucket
+        if self.aggregator:
+            agg_bucket = self.args.aggregate_bucket or self.args.influxdb_bucket
+            if not self.args.aggregate_bucket:
+                raw_bucket = None
 
         while True:
-            log.info('=== Poll controller ===')
-            influx_fields = await self.perform_regular_query()
+            if not self.vito_proto.ready():
+                # unsynced or tcp link down, don't spin with --sleep 0
+                await asyncio.sleep(NOT_READY_WAIT)
+                continue
+
+            if not self.args.log_summary:
+                log.info('=== Poll controller ===')
+            self.next_cycle = None
+            t_start = time.monotonic()
+            items = self.varlist
+            if self.scheduler:
+                items = self.scheduler.due(t_start)
+            influx_fields = await self.perform_regular_query(items)
+            self.cycle_times.append(time.monotonic() - t_start)
 
             if influx_fields:
-                js_body = {
-                    'measurement': self.args.influxdb_measurement,
-                    'time': datetime.datetime.now(datetime.UTC),
-                    'fields': influx_fields
-                }
-                pt = influxdb_client.Point.from_dict(
-                    js_body, influxdb_client.WritePrecision.NS)
-                datapoint_storage.append(pt)
+                now = datetime.datetime.now(datetime.UTC)
+                if raw_bucket:
+                    datapoint_storage[raw_bucket].append(
+                        self.make_point(now, influx_fields))
+
+                if self.aggregator:
+                    agg = self.aggregator.add(now.timestamp(), influx_fields)
+                    if agg:
+                        t_window, agg_fields = agg
+                        t = datetime.datetime.fromtimestamp(t_window, datetime.UTC)
+                        datapoint_storage[agg_bucket].append(
+                            self.make_point(t, agg_fields))
+
+                if self.publisher:
+                    self.publisher.publish(self.args.influxdb_measurement,
+                                           influx_fields)
+
+                if self.store:
+                    self.store.append_fields(now.timestamp(), influx_fields)
 
             influx_fields['timestamp'] = datetime.datetime.now().isoformat()
 
             poll_ctr += 1
 
             if poll_ctr >= self.args.batch_submit:
-                if self.influx_client and datapoint_storage:
+                for bucket, points in datapoint_storage.items():
+                    if not self.influx_client or not points:
+                        continue
                     try:
                         wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
                         write_api = self.influx_client.write_api(wr_opts)
-                        write_api.write(self.args.influxdb_bucket,
-                                        self.args.influxdb_org, datapoint_storage)
+                        write_api.write(bucket, self.args.influxdb_org, points)
                     except Exception as e:
                         log.error('Error writing to influxdb!', exc_info=True)
                 datapoint_storage.clear()
+                if self.store:
+                    self.store.flush()
                 poll_ctr = 0
 
-            await asyncio.sleep(self.args.sleep)
+            if self.scheduler:
+                self.next_cycle = self.scheduler.next_due()
+            else:
+                self.next_cycle = time.monotonic() + self.args.sleep
+            await asyncio.sleep(max(0.0, self.next_cycle - time.monotonic()))
 
 
-def main():
+def make_parser():
     import argparse
 
-    ###
-    # parse command-line arguments
-    ###
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', help='Debug mode.',
                         action='store_true')
     parser.add_argument(
         '-q', '--quiet', help='Quiet mode, less output.', action='store_true')
+    parser.add_argument('--log-summary', action='store_true',
+                        help='''Log one line per poll cycle with the values that
+changed and the error count, instead of one line per variable.''')
+    parser.add_argument('--log-rate-limit', metavar='SEC', default=60, type=float,
+                        help='''Log a repeated warning or error at most once
+per SEC seconds, with the number of repetitions. 0: off [def: %(default)s]''')
 
     parser.add_argument('-t', '--tty', metavar='DEV', default='/dev/ttyUSB0',
-                        help='Serial port, [def: /dev/ttyUSB0]', )
+                        help='''Serial port, or tcp://HOST:PORT of a raw tcp serial
+bridge to the adapter (e.g. ser2net, 4800 8E2 on the remote side).
+[def: /dev/ttyUSB0]''')
+    parser.add_argument('--link-latency', metavar='SEC', default=None, type=float,
+                        help='''Extra round-trip time of the link to the adapter,
+added to the read timeouts. [def: 0.1 for tcp://, 0 for serial ports]''')
 
     parser.add_argument('-s', '--sleep', metavar='SEC', default=15, type=int,
-                        help='Time to sleep between queries.')
+                        help='''Time to sleep between queries. With poll rules in the
+variable list this is the default poll interval of each variable.''')
     parser.add_argument('-B', '--batch-submit', metavar='N', default=5, type=int,
                         help='Only submit in batches of N to database. [def: %(default)d]')
 
@@ -179,7 +657,43 @@ def main():
                         help='''Run webserver to submit queries on
 http://localhost:PORT/query/address/length_or_tag where length may be one
 of the allowed data types (e.g. degC, uint8, ...) or number of bytes to read.
+Several addresses can be read at once by POSTing a json list of
+[address, length_or_tag] pairs to http://localhost:PORT/query. [def: off]''')
+
+    parser.add_argument('-L', '--loop-lag', metavar='MS', default=100, type=int,
+                        help='''Report event loop stalls longer than MS milliseconds
+and what was running at that time, statistics on /stats. 0: off [def: %(default)d]''')
+
+    parser.add_argument('-W', '--web-workers', metavar='N', default=0, type=int,
+                        help='''Serve the webserver from N separate processes, so web
+clients do not delay the serial protocol. Only /query is passed on to this
+process. 0: serve from this process [def: off]''')
+
+    parser.add_argument('-F', '--prefetch', metavar='N', default=0, type=int,
+                        help='''Keep the answers for the N (address, length) pairs most
+often asked for on the webserver fresh, by reading them while the bus is idle.
 [def: off]''')
+    parser.add_argument('--prefetch-age', metavar='SEC', default=10.0, type=float,
+                        help='''With --prefetch, web queries are answered from
+answers up to SEC seconds old, prefetched or from the regular poll.
+[def: %(default)s]''')
+
+    parser.add_argument('-D', '--derived', metavar='FILE', default=None,
+                        help='''File with values derived from the polled variables,
+e.g. burner starts per hour. They are written to the database and shown on
+/sensor along with the variables. [def: off]''')
+
+    parser.add_argument('-P', '--publish', metavar='GROUP:PORT', nargs='?',
+                        const=publisher.DEFAULT_ADDR, default=None,
+                        help='''Publish each poll's values as CBOR on UDP multicast
+for local consumers, see publisher.py. [def: off, %(const)s if given without argument]''')
+    parser.add_argument('--publish-lan', action='store_true',
+                        help='Publish on the LAN segment, not only on this host. [def: off]')
+
+    parser.add_argument('--store', metavar='DIR', default=None,
+                        help='''Also write the samples to a local file per variable
+in DIR, e.g. with -i - to run without InfluxDB, see tsstore.py. Queried on
+http://localhost:PORT/store/NAME?start=T&end=T&step=SEC. [def: off]''')
 
     grp = parser.add_argument_group('InfluxDB Related')
     grp.add_argument('-i', '--influxdb-url', metavar='URL', type=str,
@@ -194,11 +708,41 @@ of the allowed data types (e.g. degC, uint8, ...) or number of bytes to read.
                      type=str, help='Influxdb bucket [def: %(default)s]')
     grp.add_argument('-m', '--influxdb-measurement', metavar='MEASNAME', default='optolink',
                      help='Influxdb measurement name to use [def: optolink]')
+    grp.add_argument('-A', '--aggregate', metavar='SEC', default=0, type=int,
+                     help='''Write min, max, mean and last of each field per SEC
+seconds instead of every sample. [def: off]''')
+    grp.add_argument('--aggregate-bucket', metavar='bucket', default=None,
+                     help='''Write aggregates to this bucket and keep writing raw
+samples to --influxdb-bucket. [def: aggregates replace raw samples]''')
 
     parser.add_argument('variablelist',
                         help='''File with variables to query regularly.''')
 
-    args = parser.parse_args()
+    return parser
+
+
+def make_webapp(poll_mainloop):
+    webapp = web.Application()
+    webapp.add_routes([
+        web.get('/query/{addr}/{tag_or_len}',
+                poll_mainloop.handle_web_query),
+        web.post('/query', poll_mainloop.handle_web_batch_query),
+        web.get('/sensor', poll_mainloop.handle_sensor_query),
+        web.get('/stats', poll_mainloop.handle_stats_query)
+    ])
+    if poll_mainloop.store:
+        webapp.add_routes([
+            web.get('/store', poll_mainloop.handle_store_query),
+            web.get('/store/{name}', poll_mainloop.handle_store_query),
+        ])
+    return webapp
+
+
+def main():
+    ###
+    # parse command-line arguments
+    ###
+    args = make_parser().parse_args()
 
     lvl = logging.INFO
     if args.quiet:
@@ -207,6 +751,28 @@ of the allowed data types (e.g. degC, uint8, ...) or number of bytes to read.
         lvl = logging.DEBUG
 
     logging.basicConfig(level=lvl, format='%(asctime)-15s %(message)s')
+    log_util.add_rate_limit(args.log_rate_limit)
+
+    ###
+    # web workers, forked before anything else is set up
+    ###
+    snapshot = None
+    poller_socket = None
+    workers = list()
+    if args.webserver and args.web_workers > 0:
+        snapshot = web_frontend.Snapshot()
+        atexit.register(snapshot.close)
+        sock_dir = tempfile.mkdtemp(prefix='py-viessmann-log-')
+        atexit.register(shutil.rmtree, sock_dir, True)
+        poller_socket = os.path.join(sock_dir, 'poller.sock')
+
+        ctx = multiprocessing.get_context('fork')
+        for i in range(args.web_workers):
+            p = ctx.Process(target=web_frontend.run_worker, daemon=True,
+                            args=(args.webserver, snapshot, poller_socket,
+                                  args.store, os.getpid()))
+            p.start()
+            workers.append(p)
 
     loop = asyncio.new_event_loop()
 
@@ -216,14 +782,21 @@ of the allowed data types (e.g. degC, uint8, ...) or number of bytes to read.
     variablelist = viessmann_decode.load_variable_list(args.variablelist)
 
     ###
-    # serial interface
+    # serial interface, local or over tcp
     ###
-    vito_transp, vito_proto = loop.run_until_complete(
-        serial_asyncio.create_serial_connection(
-            loop, vitotronic.VitoTronicProtocol, args.tty,
-            baudrate=4800, bytesize=8, parity='E', stopbits=2
+    tcp_addr = vitotronic.parse_tcp_url(args.tty)
+    if tcp_addr:
+        if args.link_latency is None:
+            args.link_latency = 0.1
+        vito_proto = vitotronic.VitoTronicProtocol()
+        loop.create_task(vitotronic.TcpLink(vito_proto, *tcp_addr).run())
+    else:
+        vito_transp, vito_proto = loop.run_until_complete(
+            serial_asyncio.create_serial_connection(
+                loop, vitotronic.VitoTronicProtocol, args.tty,
+                baudrate=4800, bytesize=8, parity='E', stopbits=2
+            )
         )
-    )
 
     ###
     # influxdb
@@ -236,27 +809,48 @@ of the allowed data types (e.g. degC, uint8, ...) or number of bytes to read.
 
     poll_mainloop = PollMainLoop(vito_proto, influx_client, variablelist, args)
     loop.create_task(poll_mainloop.tick())
+    if poll_mainloop.hot_cache:
+        loop.create_task(poll_mainloop.prefetch())
+
+    if args.loop_lag > 0:
+        poll_mainloop.loop_monitor = loop_monitor.LoopMonitor(
+            threshold=1e-3 * args.loop_lag)
+        poll_mainloop.loop_monitor.start(loop)
 
     if args.webserver:
         log.info(f'Configure webserver on port {args.webserver}.')
-        webapp = web.Application()
-        webapp.add_routes([
-            web.get('/query/{addr}/{tag_or_len}',
-                    poll_mainloop.handle_web_query),
-            web.get('/sensor', poll_mainloop.handle_sensor_query)
-        ])
+        webapp = make_webapp(poll_mainloop)
 
         log.info(f' ...run setup')
         runner = web.AppRunner(webapp)
         loop.run_until_complete(runner.setup())
 
         log.info(f' ...configure site')
-        site = web.TCPSite(runner, None, args.webserver)
+        if snapshot:
+            # the workers serve the port, this only answers their /query
+            site = web.UnixSite(runner, poller_socket)
+            poll_mainloop.snapshot = snapshot
+            loop.create_task(poll_mainloop.write_snapshots())
+        else:
+            site = web.TCPSite(runner, None, args.webserver)
         loop.run_until_complete(site.start())
 
+    # a dead worker would leave the port unanswered, stop with an error
+    watch_task = None
+    if workers:
+        watch_task = loop.create_task(web_frontend.watch_workers(workers))
+        watch_task.add_done_callback(lambda task: loop.stop())
+
+    # systemd stops us with SIGTERM, leave through a normal exit so the
+    # atexit cleanup (shared memory, socket dir) runs
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
     log.info(f'Entering main loop.')
     loop.run_forever()
 
+    if watch_task and watch_task.done() and not watch_task.cancelled():
+        raise SystemExit(1)
+
 
 if __name__ == '__main__':
     main()
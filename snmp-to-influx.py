@@ -7,10 +7,16 @@ import argparse
 import easysnmp
 from pathlib import Path
 
+import publisher
+
 
 async def mainloop(cfg, args, clt):
     sessions = dict()
 
+    pub = None
+    if args.publish:
+        pub = publisher.Publisher(args.publish, args.publish_lan)
+
     name_oid_list = [
         ('temp', '1.3.6.1.4.1.22626.1.2.1.1.0'),
         ('rh', '1.3.6.1.4.1.22626.1.2.1.2.0'),
@@ -52,13 +58,18 @@ async def mainloop(cfg, args, clt):
                 dpts = [influxdb_client.Point.from_dict(
                     js_body, influxdb_client.WritePrecision.NS)]
                 try:
-                    wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
-                    write_api = clt.write_api(wr_opts)
-                    ret = write_api.write(
-                        args.influxdb_bucket, args.influxdb_org, dpts)
+                    if clt:
+                        wr_opts = influxdb_client.client.write_api.SYNCHRONOUS
+                        write_api = clt.write_api(wr_opts)
+                        ret = write_api.write(
+                            args.influxdb_bucket, args.influxdb_org, dpts)
                 except Exception as exc:
                     print(f'Exception {repr(exc)} writing to influxdb!')
 
+                if pub:
+                    pub.publish(args.influxdb_measurement,
+                                js_body['fields'], tags=js_body['tags'])
+
         await asyncio.sleep(args.sleep)
 
 
@@ -66,7 +77,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('configjson', type=Path)
 
-    parser.add_argument('-i', '--influxdb-url', help='Influxdb host. [def: %(default)s]',
+    parser.add_argument('-i', '--influxdb-url', help='Influxdb host, - to only publish with -P. [def: %(default)s]',
                         metavar='host', type=str, default='http://127.0.0.1:8086/')
     parser.add_argument('-o', '--influxdb-org', help='Influxdb org. [def: %(default)s]',
                         metavar='org', type=str, default='vogel.cx')
@@ -78,13 +89,22 @@ if __name__ == '__main__':
                         metavar='file', type=Path)
     parser.add_argument('-s', '--sleep', help='Sleep between collections [def: %(default)d]',
                         metavar='SEC', type=int, default=60)
+    parser.add_argument('-P', '--publish', metavar='GROUP:PORT', nargs='?',
+                        const=publisher.DEFAULT_ADDR, default=None,
+                        help='Publish readings on UDP multicast. [def: off, %(const)s if given without argument]')
+    parser.add_argument('--publish-lan', action='store_true',
+                        help='Publish on the LAN segment, not only on this host. [def: off]')
 
     args = parser.parse_args()
+    if args.influxdb_url == '-' and not args.publish:
+        parser.error('-i - without -P would neither write nor publish.')
 
     cfg = json.load(args.configjson.open())
 
-    token = args.influxdb_token_file.open().readline().strip()
-    clt = influxdb_client.InfluxDBClient(url=args.influxdb_url, token=token)
+    clt = None
+    if args.influxdb_url and args.influxdb_url != '-':
+        token = args.influxdb_token_file.open().readline().strip()
+        clt = influxdb_client.InfluxDBClient(url=args.influxdb_url, token=token)
 
     event_loop = asyncio.new_event_loop()
     event_loop.run_until_complete(mainloop(cfg, args, clt))
@@ -0,0 +1,10 @@
+#!/usr/bin/python
+#
+# Small helpers for the latency statistics on /stats, shared by the
+# protocol, the bus arbiter, the loop monitor and the benchmark.
+#
+
+
+def percentile(s, q):
+    '''Value at quantile q (0..1) of the sorted list s, None if empty.'''
+    return s[min(len(s) - 1, int(q * len(s)))] if s else None
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bus_arbiter  # noqa: E402
+
+
+class CancelRaceTest(unittest.TestCase):
+    '''A waiter cancelled in the same step as the bus is released.'''
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 5))
+
+    def test_release_skips_cancelled_waiter(self):
+        async def main():
+            arb = bus_arbiter.BusArbiter(limits={})
+            await arb.acquire(bus_arbiter.SCHEDULED)
+
+            waiter = asyncio.create_task(arb.acquire(bus_arbiter.INTERACTIVE))
+            await asyncio.sleep(0)  # queued
+            self.assertEqual(len(arb.waiters[bus_arbiter.INTERACTIVE]), 1)
+
+            waiter.cancel()
+            arb.release()  # before the waiter's task runs again
+            self.assertFalse(arb.busy)
+
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertFalse(arb.busy)
+            self.assertFalse(any(arb.waiters))
+
+            async with arb.slot(bus_arbiter.SCHEDULED, 0.1):
+                pass
+            self.assertFalse(arb.busy)
+
+        self.run_async(main())
+
+    def test_release_hands_bus_to_next_waiter(self):
+        async def main():
+            arb = bus_arbiter.BusArbiter(limits={})
+            await arb.acquire(bus_arbiter.SCHEDULED)
+
+            first = asyncio.create_task(arb.acquire(bus_arbiter.INTERACTIVE))
+            second = asyncio.create_task(arb.acquire(bus_arbiter.SCHEDULED))
+            await asyncio.sleep(0)
+
+            first.cancel()
+            arb.release()
+            await second  # got the bus instead of the cancelled waiter
+            self.assertTrue(arb.busy)
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+
+            arb.release()
+            self.assertFalse(arb.busy)
+
+        self.run_async(main())
+
+    def test_slot_timeout_at_release(self):
+        # the holder releases while the waiter's timeout fires
+        async def main():
+            arb = bus_arbiter.BusArbiter(limits={})
+            for i in range(50):
+                async def holder():
+                    async with arb.slot(bus_arbiter.SCHEDULED):
+                        await asyncio.sleep(0.01)
+
+                async def waiter():
+                    try:
+                        async with arb.slot(bus_arbiter.INTERACTIVE, 0.01):
+                            pass
+                    except asyncio.TimeoutError:
+                        pass
+
+                await asyncio.gather(holder(), waiter())
+                self.assertFalse(arb.busy)
+                self.assertFalse(any(arb.waiters))
+
+        self.run_async(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+#
+# Join samples from several sources (optolink, onewire, snmp, ...) onto a
+# common time grid: at every tick, each field gets its latest value, as
+# long as that is not older than max_age. Fields are named
+# <source>_<name>, with the values of the tags appended to the source if
+# it has any (e.g. indoors_ca562d0_temp).
+#
+
+import logging
+
+log = logging.getLogger('time_join')
+
+
+def field_prefix(source, tags=None):
+    if not tags:
+        return source
+    return '_'.join([source] + [str(v) for k, v in sorted(tags.items())])
+
+
+class GridJoiner:
+    def __init__(self, cadence, max_age):
+        self.cadence = cadence
+        self.max_age = max_age
+        self.latest = dict()  # field -> (t, value)
+
+    def add(self, source, t, fields, tags=None):
+        prefix = field_prefix(source, tags)
+        for name, v in fields.items():
+            self.latest[prefix + '_' + name] = (t, v)
+
+    def next_tick(self, now):
+        return now - now % self.cadence + self.cadence
+
+    def tick(self, t_tick):
+        '''Fields for the grid point at t_tick, stale values are dropped.'''
+        ret = dict()
+        for name, (t, v) in list(self.latest.items()):
+            if t_tick - t > self.max_age:
+                del self.latest[name]
+                continue
+            if t <= t_tick:
+                ret[name] = v
+        return ret
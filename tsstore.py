@@ -0,0 +1,241 @@
+#!/usr/bin/python
+#
+# Local time series store, an alternative to InfluxDB for small
+# installations. One file <name>.ts per variable of fixed size records
+# (int64 ns since epoch, float64 value), appended in time order. Every
+# INDEX_EVERY records, (t, record number) goes to <name>.idx, so a time
+# range is found by bisecting the small index in memory and then at most
+# INDEX_EVERY records of the memory-mapped data file.
+#
+# Run as a script to list the variables of a store or print a range:
+#   tsstore.py DIR
+#   tsstore.py DIR NAME [--start T] [--end T] [--step SEC]
+#
+
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import re
+import struct
+
+log = logging.getLogger('tsstore')
+
+RECORD = struct.Struct('<qd')  # t [ns], value
+INDEX = struct.Struct('<qq')  # t [ns], record number
+INDEX_EVERY = 1024
+NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+class _Series:
+    '''Append side of one variable.'''
+    def __init__(self, base):
+        self.f_data = open(base + '.ts', 'ab')
+        size = self.f_data.tell()
+        if size % RECORD.size:
+            log.warning('%s.ts: dropping incomplete record at the end', base)
+            size -= size % RECORD.size
+            self.f_data.truncate(size)
+        self.count = size // RECORD.size
+
+        self.last_t = None
+        if self.count:
+            with open(base + '.ts', 'rb') as f:
+                f.seek(size - RECORD.size)
+                self.last_t = RECORD.unpack(f.read(RECORD.size))[0]
+
+        # the index is rebuilt from the data if it does not match, e.g.
+        # after a crash between writing data and index, or if it ends in
+        # a partial entry that later entries would be misaligned behind
+        idx = _load_index(base)
+        n_idx = (self.count + INDEX_EVERY - 1) // INDEX_EVERY
+        try:
+            idx_torn = os.path.getsize(base + '.idx') % INDEX.size != 0
+        except FileNotFoundError:
+            idx_torn = False
+        if len(idx) != n_idx or idx_torn:
+            log.warning('%s.idx: rebuilding index', base)
+            with open(base + '.idx', 'wb') as f:
+                with open(base + '.ts', 'rb') as f_data:
+                    for i in range(n_idx):
+                        f_data.seek(i * INDEX_EVERY * RECORD.size)
+                        t, v = RECORD.unpack(f_data.read(RECORD.size))
+                        f.write(INDEX.pack(t, i * INDEX_EVERY))
+        self.f_idx = open(base + '.idx', 'ab')
+
+    def append(self, t_ns, v):
+        if self.last_t is not None and t_ns < self.last_t:
+            log.warning('%s: dropping sample older than the last one',
+                        self.f_data.name)
+            return
+        if self.count % INDEX_EVERY == 0:
+            self.f_idx.write(INDEX.pack(t_ns, self.count))
+        self.f_data.write(RECORD.pack(t_ns, v))
+        self.count += 1
+        self.last_t = t_ns
+
+    def flush(self):
+        # data first, an index entry must never point beyond the data
+        self.f_data.flush()
+        self.f_idx.flush()
+
+    def close(self):
+        self.f_data.close()
+        self.f_idx.close()
+
+
+def _load_index(base):
+    try:
+        with open(base + '.idx', 'rb') as f:
+            buf = f.read()
+    except FileNotFoundError:
+        return []
+    buf = buf[:len(buf) - len(buf) % INDEX.size]
+    return list(INDEX.iter_unpack(buf))
+
+
+class TimeSeriesStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.series = dict()  # name -> _Series, opened on first append
+
+    def _base(self, name):
+        if not NAME_RE.match(name):
+            raise ValueError('invalid series name %r' % name)
+        return os.path.join(self.directory, name)
+
+    def names(self):
+        return sorted(fn[:-3] for fn in os.listdir(self.directory)
+                      if fn.endswith('.ts'))
+
+    def append(self, name, t_ns, v):
+        s = self.series.get(name)
+        if s is None:
+            s = self.series[name] = _Series(self._base(name))
+        s.append(t_ns, float(v))
+
+    def append_fields(self, t, fields):
+        '''Append all numeric fields sampled at t (seconds since epoch).'''
+        t_ns = int(t * 1e9)
+        for name, v in fields.items():
+            if isinstance(v, (int, float)):
+                self.append(name, t_ns, v)
+
+    def flush(self):
+        for s in self.series.values():
+            s.flush()
+
+    def close(self):
+        for s in self.series.values():
+            s.close()
+        self.series.clear()
+
+    ###
+    # queries, only see what has been flushed
+    ###
+    def _records(self, name, t_start, t_end):
+        '''Yields (t_ns, value) with t_start <= t < t_end, None: open end.'''
+        base = self._base(name)
+        idx = _load_index(base)
+        try:
+            f = open(base + '.ts', 'rb')
+        except FileNotFoundError:
+            raise KeyError(name)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // RECORD.size
+            if not count:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                def t_at(i):
+                    return RECORD.unpack_from(mm, i * RECORD.size)[0]
+
+                first = 0
+                if t_start is not None:
+                    # block of the last index entry before t_start, then
+                    # bisect inside the block
+                    k = bisect.bisect_left(idx, t_start, key=lambda e: e[0])
+                    lo = idx[k - 1][1] if k > 0 else 0
+                    hi = idx[k][1] if k < len(idx) else count
+                    first = bisect.bisect_left(range(lo, hi), t_start, key=t_at) + lo
+
+                for i in range(first, count):
+                    t, v = RECORD.unpack_from(mm, i * RECORD.size)
+                    if t_end is not None and t >= t_end:
+                        break
+                    yield t, v
+
+    def read(self, name, t_start=None, t_end=None, limit=None):
+        '''List of (t_ns, value) in [t_start, t_end), at most limit.'''
+        ret = list()
+        for rec in self._records(name, t_start, t_end):
+            if limit is not None and len(ret) >= limit:
+                break
+            ret.append(rec)
+        return ret
+
+    def downsample(self, name, step_ns, t_start=None, t_end=None):
+        '''List of (t_bucket_ns, min, max, mean, n) per step_ns, buckets
+        aligned to multiples of step_ns since the epoch.'''
+        ret = list()
+        acc = None
+        for t, v in self._records(name, t_start, t_end):
+            t_bucket = t - t % step_ns
+            if acc is None or acc[0] != t_bucket:
+                if acc is not None:
+                    ret.append((acc[0], acc[1], acc[2], acc[3] / acc[4], acc[4]))
+                acc = [t_bucket, v, v, 0.0, 0]
+            acc[1] = min(acc[1], v)
+            acc[2] = max(acc[2], v)
+            acc[3] += v
+            acc[4] += 1
+        if acc is not None:
+            ret.append((acc[0], acc[1], acc[2], acc[3] / acc[4], acc[4]))
+        return ret
+
+
+def parse_time(s):
+    '''Seconds since epoch or ISO 8601 (local time if no zone) -> ns.'''
+    if s is None or s == '':
+        return None
+    try:
+        return int(float(s) * 1e9)
+    except ValueError:
+        return int(datetime.datetime.fromisoformat(s).timestamp() * 1e9)
+
+
+def format_time(t_ns):
+    return datetime.datetime.fromtimestamp(t_ns * 1e-9).astimezone().isoformat()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--start', metavar='T', help='Start time, epoch seconds or ISO 8601. [def: first sample]')
+    parser.add_argument('--end', metavar='T', help='End time, epoch seconds or ISO 8601. [def: last sample]')
+    parser.add_argument('--step', metavar='SEC', type=float, default=0,
+                        help='Print min, max, mean and count per SEC seconds. [def: all samples]')
+    parser.add_argument('-n', '--limit', metavar='N', type=int, default=None,
+                        help='Print at most N samples. [def: all]')
+    parser.add_argument('directory', help='Store directory')
+    parser.add_argument('name', nargs='?', help='Variable to print [def: list variables]')
+    args = parser.parse_args()
+
+    store = TimeSeriesStore(args.directory)
+    if not args.name:
+        for name in store.names():
+            print(name)
+        raise SystemExit(0)
+
+    t_start = parse_time(args.start)
+    t_end = parse_time(args.end)
+    if args.step > 0:
+        for t, vmin, vmax, vmean, n in store.downsample(
+                args.name, int(args.step * 1e9), t_start, t_end):
+            print('%s %g %g %g %d' % (format_time(t), vmin, vmax, vmean, n))
+    else:
+        for t, v in store.read(args.name, t_start, t_end, args.limit):
+            print('%s %g' % (format_time(t), v))
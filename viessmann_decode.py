@@ -95,6 +95,32 @@ def gen_decoder(tag_or_length):
     return length, decode_fct, fmt
 
 
+MAX_READ_LEN = 32  # longest single read we ask the controller for
+MAX_READ_GAP = 4  # unused bytes we accept to read to merge two requests
+
+
+def plan_reads(requests, max_len=MAX_READ_LEN, max_gap=MAX_READ_GAP):
+    '''Merge (addr, length) requests into as few reads as possible.
+
+    Returns a list of (addr, length, [indices into requests]), requests
+    that are close to each other are covered by one read.
+    '''
+    ret = list()
+    order = sorted(range(len(requests)), key=lambda ix: requests[ix])
+
+    for ix in order:
+        addr, length = requests[ix]
+        if ret:
+            start, rd_len, ixs = ret[-1]
+            end = max(start + rd_len, addr + length)
+            if addr - (start + rd_len) <= max_gap and end - start <= max_len:
+                ret[-1] = (start, end - start, ixs + [ix])
+                continue
+        ret.append((addr, length, [ix]))
+
+    return ret
+
+
 def load_variable_list(fn):
     ret = list()
 
@@ -105,8 +131,8 @@ def load_variable_list(fn):
                 line = line[:ix]
             line = line.strip()
 
-            if not line:
-                continue
+            if not line or line.startswith('@'):
+                continue  # empty or poll rule, see poll_schedule.py
 
             arr = line.strip().split()
             if len(arr) < 4:
@@ -2,11 +2,40 @@
 
 import asyncio
 import binascii
+import collections
 import logging
+import socket
+import time
 
+import stats_util
 from ascii_tbl import whatchar, EOT, ACK_i, NAK_i, ENQ_i
 
 SYNC_MSG = b'\x16\0\0'
+RESYNC_MAX = 300  # [bytes] give up resync, longer than any telegram
+TCP_KEEPALIVE = 10  # [s] idle time before keepalive probes on tcp links
+TCP_USER_TIMEOUT = 20  # [s] unacknowledged data before a tcp link is dropped
+
+
+def parse_telegram(buf):
+    '''Returns (msgtype, method, address, payload) of a complete telegram
+    or an error string.'''
+    ###
+    # answer for reads
+    #  msg[0] = 0x41
+    #  msg[1] = pktlen
+    #  msg[2] = 1 (answer)
+    #  msg[3] = method (read:2, functioncall: 7)
+    #  msg[4] = addr MSB
+    #  msg[5] = addr LSB
+    #  msg[6] = len(payload)
+    #  msg[7..] = payload
+    #  msg[len+7] = sum(msg[1:-1]) & 0xff
+    ###
+    if sum(buf[1:-1]) & 0xff != buf[-1]:
+        return 'Bad checksum'
+    if len(buf) < 8 or len(buf) != buf[6] + 8:
+        return 'Bad payload length'
+    return buf[2], buf[3], (buf[4] << 8) | buf[5], bytes(buf[7:-1])
 
 
 def hexlify(b):
@@ -37,10 +66,14 @@ class PrefixLoggerAdapter(logging.LoggerAdapter):
 #   |            | rx ENQ   |       | 0x41='A'
 #   |  tx SYNC   V tx SYNC  |       |
 #   |    +--> +---------+ <-+       |
-#   |    |    | sync    | >---------+
-#   |    +--< +---------+ <>---------<> rx ACK or NAK
-#   |   TO   rx  |   ^
-#   |        $41 V   | last byte, emit message
+#   |    |    | sync    | >-------+ | ENQ or
+#   |    +--< +---------+ <>------|--<> rx ACK or NAK
+#   |   TO   rx  |   ^  ^         | | overflow
+#   |        $41 V   |  | valid   V |
+#   |             |  |  +---< +--------+
+#   |    TO       |  |        | resync | >----\ rx byte
+#   +-------------|--|------< +--------+ <----/
+#   |             V  | last byte, emit message
 #   |    TO   +---------+
 #   +-------< | busy    | >----\ rx telegram byte
 #             +---------+ <----/
@@ -48,7 +81,15 @@ class PrefixLoggerAdapter(logging.LoggerAdapter):
 #
 # timeout is reset upon reception of ACK in sync state or
 # reception of message in busy state, timeout is
-# 30 seconds in sync state and 2 seconds in every other state
+# 30 seconds in sync state and 4 seconds in every other state
+#
+# In resync, received bytes are collected until they end with a telegram
+# that passes the checksum, which restores the frame alignment without a
+# new EOT/ENQ handshake with the controller. Reads may be requested in
+# resync, their answer is what realigns.
+#
+# Over a tcp link (TcpLink), a lost connection returns to Start and the
+# link reconnects with the same protocol instance.
 
 class VitoTronicProtocol(asyncio.Protocol):
     def __init__(self):
@@ -56,18 +97,57 @@ class VitoTronicProtocol(asyncio.Protocol):
         self.log = PrefixLoggerAdapter(
             _log, {'prefix': self.__class__.__name__})
         self.transport = None
+        self.tick_task = None
+        self.disconnected = asyncio.Event()  # set while there is no transport
+        self.disconnected.set()
 
         self.rx_state = self._rx_state_start
         self.rx_buf = bytearray()
         self.rx_timeout = 0
 
         self.rx_queue = list()
+        self.rx_event = asyncio.Event()  # set whenever something was received
         self.rx_ack_ctr = 0
         self.rx_nak_ctr = 0
         self.rx_to_ctr = 0
         self.rx_err_ctr = 0
         self.rx_msg_ctr = 0
 
+        # link statistics, not reset by clear_rx_queue()
+        self.resync_buf = bytearray()
+        self.t_lost = None  # time the frame alignment was lost
+        self.resync_ctr = 0
+        self.resync_fail_ctr = 0
+        self.connect_ctr = 0
+        self.recovery = {  # recovery times per path
+            'resync': collections.deque(maxlen=256),
+            'handshake': collections.deque(maxlen=256),
+        }
+
+    def _lost_sync(self):
+        if self.t_lost is None:
+            self.t_lost = time.monotonic()
+
+    def _synced(self, how):
+        if self.t_lost is not None:
+            self.recovery[how].append(time.monotonic() - self.t_lost)
+            self.t_lost = None
+
+    def link_stats(self):
+        ret = {
+            'connects': self.connect_ctr,
+            'resyncs': self.resync_ctr,
+            'resyncs_failed': self.resync_fail_ctr,
+        }
+        for how, times in self.recovery.items():
+            t = sorted(times)
+            ret[how] = {
+                'n': len(t),
+                'p50': stats_util.percentile(t, 0.5),
+                'max': t[-1] if t else None,
+            }
+        return ret
+
     ###
     # state handler
     ###
@@ -79,6 +159,7 @@ class VitoTronicProtocol(asyncio.Protocol):
         if c == NAK_i:
             self.log.debug('Received NAK, sending sync sequence.')
             self.transport.write(SYNC_MSG)
+            self._synced('handshake')
             return self._rx_state_sync
         if c == ENQ_i:
             self.log.debug('Received ENQ, sending EOT.')
@@ -92,6 +173,7 @@ class VitoTronicProtocol(asyncio.Protocol):
         if c == ENQ_i:
             self.log.debug('Received ENQ, sending sync sequence.')
             self.transport.write(SYNC_MSG)
+            self._synced('handshake')
             return self._rx_state_sync
         else:
             self.log.warning('Unexpected %s in sync start.', whatchar(c))
@@ -108,86 +190,131 @@ class VitoTronicProtocol(asyncio.Protocol):
                 self.rx_ack_ctr += 1
             else:
                 self.rx_nak_ctr += 1
-            self.log.debug('Received %s.', whatchar(c))
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug('Received %s.', whatchar(c))
             self.rx_timeout = 0
         elif c == 0x41:  # start of newly received packet
             self.rx_buf.clear()
             self.rx_buf.append(c)
             return self._rx_state_busy
         else:
-            self.log.warning('Unexpected %s received.', whatchar(c))
-            self.rx_err_ctr += 1
+            # not counted as rx error, resync may still deliver the answer
+            self.log.warning('Unexpected %s received, resyncing.', whatchar(c))
+            self.resync_ctr += 1
+            self._lost_sync()
+            self.resync_buf.clear()
+            self.resync_buf.append(c)
+            self.rx_timeout = 0
+            return self._rx_state_resync
+
+    def _rx_state_resync(self, c):
+        buf = self.resync_buf
+        buf.append(c)
+        if len(buf) > RESYNC_MAX:
+            self.log.error('No valid telegram in %d bytes, starting over.',
+                           len(buf))
+            self.resync_fail_ctr += 1
+            buf.clear()
+            self.transport.write(EOT)
             return self._rx_state_unsync
 
+        # a telegram ending with this byte, starting at any 0x41 before
+        pending = False  # a telegram that may still complete
+        i = buf.find(0x41)
+        while i >= 0:
+            if len(buf) - i < 2 or buf[i + 1] + 3 > len(buf) - i:
+                pending = True
+            elif buf[i + 1] + 3 == len(buf) - i and len(buf) - i >= 8:
+                ret = parse_telegram(buf[i:])
+                if type(ret) == tuple and ret[0] in (1, 3):
+                    self.log.info('Resynced after %d bytes.', i)
+                    self._emit(ret)
+                    buf.clear()
+                    self._synced('resync')
+                    self.rx_timeout = 0
+                    return self._rx_state_sync
+            i = buf.find(0x41, i + 1)
+
+        # ENQ outside of any telegram: the controller has dropped the
+        # connection itself. Inside one, it is just a data byte.
+        if c == ENQ_i and not pending:
+            self.log.warning('Received ENQ while resyncing.')
+            self.resync_fail_ctr += 1
+            buf.clear()
+            return self._rx_state_unsync(c)
+
     def _rx_state_busy(self, c):
         self.rx_buf.append(c)
 
         if len(self.rx_buf) == 0 or len(self.rx_buf) < self.rx_buf[1] + 3:
             return
 
-        ###
-        # answer for reads
-        #  msg[0] = 0x41
-        #  msg[1] = pktlen
-        #  msg[2] = 1 (answer)
-        #  msg[3] = method (read:2, functioncall: 7)
-        #  msg[4] = addr MSB
-        #  msg[5] = addr LSB
-        #  msg[6] = len(payload)
-        #  msg[7..] = payload
-        #  msg[len+7] = sum(msg[1:-1]) & 0xff
-        ###
-
-        telegram_ascii = hexlify(self.rx_buf)
-        chksum = sum(self.rx_buf[1:-1]) & 0xff
-
-        if chksum != self.rx_buf[-1]:
-            self.log.error('Bad checksum: %s', telegram_ascii)
-            self.rx_err_ctr += 1
-        elif len(self.rx_buf) != self.rx_buf[6] + 8:
-            self.log.error('Bad payload length: %s', telegram_ascii)
-            self.rx_err_ctr += 1
+        ret = parse_telegram(self.rx_buf)
+        if type(ret) == tuple:
+            self._emit(ret)
         else:
+            self.log.error('%s: %s', ret, hexlify(self.rx_buf))
+            self.rx_err_ctr += 1
 
-            msgtype = self.rx_buf[2]
-            method = self.rx_buf[3]
-            address = (self.rx_buf[4] << 8) | self.rx_buf[5]
-            payload = self.rx_buf[7:-1]
+        self.rx_timeout = 0
+        return self._rx_state_sync
 
+    def _emit(self, telegram):
+        msgtype, method, address, payload = telegram
+        if self.log.isEnabledFor(logging.DEBUG):
             self.log.debug('Received %d/%d/0x%04x %s',
                            msgtype, method, address, hexlify(payload))
-            self.rx_queue.append((msgtype, method, address, payload))
-
-            self.rx_msg_ctr += 1
-
-        self.rx_timeout = 0
-        return self._rx_state_sync
+        self.rx_queue.append(telegram)
+        self.rx_msg_ctr += 1
 
     ###
     # callbacks from transport
     ###
     def connection_made(self, transport):
-        self.log.extra['prefix'] = transport._serial.port
+        serial = getattr(transport, '_serial', None)
+        if serial is not None:
+            self.log.extra['prefix'] = serial.port
+        else:
+            peer = transport.get_extra_info('peername')
+            self.log.extra['prefix'] = '%s:%d' % peer[:2] if peer else 'tcp'
         self.transport = transport
-        self.transport._loop.create_task(self.tick())
+        self.connect_ctr += 1
+        self.disconnected.clear()
+        # the same protocol instance is reused when a tcp link reconnects
+        if self.tick_task is None:
+            self.tick_task = self.transport._loop.create_task(self.tick())
         self.transport.write(EOT)
 
     def connection_lost(self, exc):
-        pass  # should not happen with serial port
+        # only happens with tcp links, TcpLink reconnects
+        self.log.error('Connection lost: %s', exc or 'closed by peer')
+        self.transport = None
+        if self.rx_state != self._rx_state_start:
+            self._lost_sync()
+        self.rx_state = self._rx_state_start
+        self.rx_timeout = 0
+        self.disconnected.set()
+        self.rx_event.set()
 
     def data_received(self, data):
-        # upon start, we might have a lot of junk in the
-        # stale RX buffer of the serial interface
+        # upon start, we might have a lot of junk in the stale RX
+        # buffer of the serial interface, only the controller's last ENQ
+        # in it is of interest
         if self.rx_state == self._rx_state_start:
             self.rx_state = self._rx_state_unsync
             if len(data) > 1:
-                return
+                i = data.rfind(ENQ_i)
+                if i < 0:
+                    return
+                data = data[i:]
 
         for d in data:
             new_state = self.rx_state(d)
             if new_state:
                 self.rx_state = new_state
 
+        self.rx_event.set()
+
     def eof_received(self):
         return False  # should close the transport
 
@@ -198,6 +325,9 @@ class VitoTronicProtocol(asyncio.Protocol):
         while True:
             await asyncio.sleep(0.5)
 
+            if self.transport is None:
+                continue  # tcp link is down
+
             if self.rx_state == self._rx_state_sync:
                 if self.rx_timeout >= 60:  # 30sec
                     self.transport.write(SYNC_MSG)
@@ -208,9 +338,13 @@ class VitoTronicProtocol(asyncio.Protocol):
                 self.log.error('RX Timeout in state %s.',
                                self.rx_state.__name__)
                 self.rx_to_ctr += 1
+                if self.rx_state == self._rx_state_resync:
+                    self.resync_fail_ctr += 1
+                self._lost_sync()
                 self.rx_state = self._rx_state_unsync
                 self.transport.write(EOT)
                 self.rx_timeout = 0
+                self.rx_event.set()
                 continue
 
             self.rx_timeout += 1
@@ -223,8 +357,15 @@ class VitoTronicProtocol(asyncio.Protocol):
         self.rx_to_ctr = 0
         self.rx_queue.clear()
 
+    def ready(self):
+        '''True if a read can be requested.'''
+        return self.transport is not None and self.rx_state in (
+            self._rx_state_sync, self._rx_state_resync)
+
     def request_read(self, addr, exp_len):
-        if self.rx_state != self._rx_state_sync:
+        if self.rx_state == self._rx_state_resync:
+            self.resync_buf.clear()  # the answer will realign
+        elif self.rx_state != self._rx_state_sync:
             if self.rx_state:
                 self.log.error('request_read() in state %s',
                                self.rx_state.__name__)
@@ -246,3 +387,66 @@ class VitoTronicProtocol(asyncio.Protocol):
 
         self.transport.write(msg)
         return False
+
+
+###
+# raw tcp serial bridge (ser2net style) instead of a local serial port
+###
+
+def parse_tcp_url(tty):
+    '''Returns (host, port) for tcp://host:port, None for anything else.'''
+    if not tty.startswith('tcp://'):
+        return None
+    host, sep, port = tty[len('tcp://'):].rpartition(':')
+    if not sep or not host:
+        raise ValueError('%s is not tcp://host:port' % tty)
+    return host.strip('[]'), int(port)
+
+
+def set_keepalive(sock):
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # linux only, a half-dead bridge is noticed within seconds, not hours
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 2)
+    if hasattr(socket, 'TCP_USER_TIMEOUT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT,
+                        1000 * TCP_USER_TIMEOUT)
+
+
+class TcpLink:
+    '''Keeps proto connected to host:port, reconnecting with exponential
+    backoff. The protocol instance stays the same across reconnects.'''
+
+    def __init__(self, proto, host, port, min_backoff=1.0, max_backoff=60.0):
+        self.proto = proto
+        self.host = host
+        self.port = port
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        log = self.proto.log
+        backoff = self.min_backoff
+        while True:
+            try:
+                transport, _ = await loop.create_connection(
+                    lambda: self.proto, self.host, self.port)
+            except OSError as e:
+                log.error('Cannot connect to %s:%d: %s', self.host, self.port, e)
+                await asyncio.sleep(backoff)
+                backoff = min(2 * backoff, self.max_backoff)
+                continue
+
+            set_keepalive(transport.get_extra_info('socket'))
+            t_connect = loop.time()
+            await self.proto.disconnected.wait()
+
+            # a link that was up for a while starts over with short backoff
+            if loop.time() - t_connect > self.max_backoff:
+                backoff = self.min_backoff
+            await asyncio.sleep(backoff)
+            backoff = min(2 * backoff, self.max_backoff)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# Webserver in worker processes, so that HTTP clients do not share the
+# event loop with the serial protocol. The poller writes the latest
+# values and its statistics as JSON to a shared memory Snapshot, guarded
+# by a sequence counter (seqlock): odd while a write is in progress, a
+# reader retries if it changed while copying. Workers answer /sensor,
+# /stats and /store (read-only from the files) themselves and forward
+# only /query, which needs the bus, to the poller's webserver on a unix
+# socket. All workers listen on the same port (SO_REUSEPORT). If a worker
+# dies, the poller exits with an error instead of leaving the port to
+# the remaining ones, or to nobody.
+#
+
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+import aiohttp
+from aiohttp import web
+
+import tsstore
+
+log = logging.getLogger('web_frontend')
+
+SNAPSHOT_SIZE = 1 << 20
+HEADER = struct.Struct('<QI')  # sequence, length of json
+SEQ = struct.Struct('<Q')
+STORE_MAX_SAMPLES = 10000  # max. raw samples in one /store answer
+PARENT_CHECK = 1.0  # [s] how often a worker checks its poller is alive
+
+
+class Snapshot:
+    def __init__(self, size=SNAPSHOT_SIZE):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.buf = self.shm.buf
+        self.n_retry = 0
+
+    def write(self, obj):
+        data = json.dumps(obj).encode()
+        if HEADER.size + len(data) > len(self.buf):
+            log.error('Snapshot of %d bytes does not fit into shared memory.',
+                      len(data))
+            return False
+        seq = SEQ.unpack_from(self.buf)[0]
+        SEQ.pack_into(self.buf, 0, seq + 1)
+        self.buf[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.buf, 0, seq + 2, len(data))
+        return True
+
+    def sequence(self):
+        return SEQ.unpack_from(self.buf)[0]
+
+    def read(self, retries=1000):
+        '''Returns (sequence, json bytes), None if nothing written yet.'''
+        for i in range(retries):
+            seq, n = HEADER.unpack_from(self.buf)
+            if not seq & 1:
+                data = bytes(self.buf[HEADER.size:HEADER.size + n])
+                if SEQ.unpack_from(self.buf)[0] == seq:
+                    return (seq, data) if seq else None
+            self.n_retry += 1
+            time.sleep(0)
+        return None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+async def store_response(store, request):
+    '''/store and /store/{name}, for the poller and the workers.'''
+    if 'name' not in request.match_info:
+        return web.json_response(store.names())
+
+    try:
+        name = request.match_info['name']
+        t_start = tsstore.parse_time(request.query.get('start'))
+        t_end = tsstore.parse_time(request.query.get('end'))
+        step = float(request.query.get('step', 0))
+        limit = min(int(request.query.get('limit', STORE_MAX_SAMPLES)),
+                    STORE_MAX_SAMPLES)
+    except Exception as e:
+        return web.Response(status=400, text='Invalid query: %s' % e)
+
+    # file access off the event loop
+    def query():
+        if step > 0:
+            return [[tsstore.format_time(t), vmin, vmax, vmean, n]
+                    for t, vmin, vmax, vmean, n in store.downsample(
+                        name, int(step * 1e9), t_start, t_end)]
+        return [[tsstore.format_time(t), v]
+                for t, v in store.read(name, t_start, t_end, limit)]
+
+    try:
+        ret = await asyncio.get_running_loop().run_in_executor(None, query)
+    except (KeyError, ValueError):
+        return web.Response(status=404, text='No such variable.')
+    return web.json_response(ret)
+
+
+class Worker:
+    def __init__(self, snapshot, poller_socket, store_dir):
+        self.snapshot = snapshot
+        self.poller_socket = poller_socket
+        self.store = tsstore.TimeSeriesStore(store_dir) if store_dir else None
+        self.session = None
+
+        self.seq = None
+        self.parsed = dict()
+        self.n_forwarded = 0
+
+    def _current(self):
+        # parse the snapshot only when it has changed
+        seq = self.snapshot.sequence()
+        if seq != self.seq:
+            ret = self.snapshot.read()
+            if ret is not None:
+                try:
+                    self.parsed = json.loads(ret[1])
+                    self.seq = ret[0]
+                except ValueError:
+                    # torn read despite the sequence check, keep the last one
+                    log.warning('Cannot parse snapshot %d.', ret[0])
+        return self.parsed
+
+    async def handle_sensor_query(self, request):
+        return web.json_response(self._current().get('sensor', {}))
+
+    async def handle_stats_query(self, request):
+        snap = self._current()
+        stats = dict(snap.get('stats', {}))
+        stats['web'] = {
+            'pid': os.getpid(),
+            'snapshot_age': time.time() - snap['t'] if 't' in snap else None,
+            'snapshot_retries': self.snapshot.n_retry,
+            'forwarded': self.n_forwarded,
+        }
+        return web.json_response(stats)
+
+    async def handle_store_query(self, request):
+        return await store_response(self.store, request)
+
+    async def forward(self, request):
+        self.n_forwarded += 1
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.poller_socket))
+        try:
+            async with self.session.request(
+                    request.method, 'http://poller' + request.rel_url.path_qs,
+                    data=await request.read(),
+                    headers={'Content-Type': request.content_type}) as resp:
+                return web.Response(
+                    status=resp.status, body=await resp.read(),
+                    headers={'Content-Type': resp.headers.get('Content-Type', 'text/plain')})
+        except aiohttp.ClientError as e:
+            log.error('Cannot forward %s to poller: %s', request.rel_url, e)
+            return web.Response(status=502, text='Poller not reachable.')
+
+    def make_webapp(self):
+        webapp = web.Application()
+        webapp.add_routes([
+            web.get('/query/{addr}/{tag_or_len}', self.forward),
+            web.post('/query', self.forward),
+            web.get('/sensor', self.handle_sensor_query),
+            web.get('/stats', self.handle_stats_query)
+        ])
+        if self.store:
+            webapp.add_routes([
+                web.get('/store', self.handle_store_query),
+                web.get('/store/{name}', self.handle_store_query),
+            ])
+        return webapp
+
+
+async def _exit_with_parent(ppid):
+    while os.getppid() == ppid:
+        await asyncio.sleep(PARENT_CHECK)
+    log.error('Poller process is gone, web worker %d exits.', os.getpid())
+    os._exit(1)
+
+
+async def watch_workers(procs):
+    '''Returns when one of the worker processes has died.'''
+    while True:
+        for p in procs:
+            if not p.is_alive():
+                log.error('Web worker %d exited with status %s.',
+                          p.pid, p.exitcode)
+                return p
+        await asyncio.sleep(PARENT_CHECK)
+
+
+def run_worker(port, snapshot, poller_socket, store_dir, ppid):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    worker = Worker(snapshot, poller_socket, store_dir)
+    runner = web.AppRunner(worker.make_webapp())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, None, port, reuse_port=True)
+    loop.run_until_complete(site.start())
+    loop.create_task(_exit_with_parent(ppid))
+
+    log.info('Web worker %d serving port %d.', os.getpid(), port)
+    loop.run_forever()